@@ -4,7 +4,6 @@
 # https://www.apache.org/licenses/LICENSE-2.0
 
 import argparse
-import subprocess
 from github_config import *
 from github_scanner import *
 
@@ -30,6 +29,22 @@ parser.add_argument('--out',
                     nargs=1,
                     default=["."],
                     help='Destination directory for GitHub clones (default: current directory)')
+parser.add_argument('--jobs',
+                    nargs=1,
+                    type=int,
+                    default=[8],
+                    help='Number of repos to clone at the same time (default: 8)')
+parser.add_argument('--sync',
+                    action="store_true",
+                    default=False,
+                    help="Bring an earlier --out directory up to date: repos nobody has pushed to since then are "
+                         "left alone, others are fetched and fast-forwarded, and new ones are cloned")
+parser.add_argument('--template',
+                    nargs=1,
+                    default=[""],
+                    help="Starter template repo (owner/name) the students' repos were made from, or 'auto' to ask "
+                         "GitHub. It's mirrored once, and the clones share its objects rather than each having "
+                         "a copy (default: no sharing)")
 
 args = parser.parse_args()
 
@@ -38,46 +53,247 @@ github_organization = args.org[0]
 github_token = args.token[0]
 out_dir = args.out[0]
 use_safe_clone = args.safe
+num_jobs = args.jobs[0]
+use_sync = args.sync
+template_name = args.template[0]
 
-filtered_repo_list = query_matching_repos(github_organization, github_prefix, github_token)
-print("%d repos found for %s/%s" % (len(filtered_repo_list), github_organization, github_prefix))
+# Every repo we've cloned or updated is listed here, in the --out directory, along with the repo's pushed_at
+# time when we did it and the commit it was on, so --sync can tell which repos haven't changed since.
+manifest_file_name = os.path.join(out_dir, ".github-clone-manifest.json")
 
-# before we start getting any repos, we need a directory to put them
-if out_dir != ".":
+# git must never stop to ask for a password: with several clones going at once, nobody would know which
+# one was asking, and the clone would wait forever
+git_environment = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+
+
+async def run_git_async(arguments: List[str], cwd: str) -> (int, str):
+    """
+    Runs git with the given arguments in the given directory, returning its exit status and whatever it
+    printed. Nothing is printed as it goes, since several of these run at once.
+    """
+    process = await asyncio.create_subprocess_exec("git", *arguments, cwd=cwd, env=git_environment,
+                                                   stdin=asyncio.subprocess.DEVNULL,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT)
+    output, _ = await process.communicate()
+    # the token could turn up in an error message, as part of the URL, and we're going to print those
+    return process.returncode, output.decode('utf-8', 'replace').replace(github_token + '@', '<token>@')
+
+
+def find_template_name(repos: List[dict]) -> str:
+    """
+    Asks GitHub which template the first of the repos was made from, which, for a GitHub Classroom
+    assignment, is the starter code every student's repo was made from. Returns "" if there isn't one.
+    (The organization's repo listing doesn't say, so this costs a request, but only one.)
+    """
+    if not repos:
+        return ""
+    template = get_github_endpoint('repos/' + repos[0]['full_name'], github_token).get('template_repository')
+    return template['full_name'] if template else ""
+
+
+def prepare_template_mirror(template_full_name: str) -> str:
+    """
+    Mirrors the template repo into out_dir, or brings the mirror up to date if it's already there. Every
+    clone we make borrows objects from the mirror (via git's "alternates"), so the history they have in
+    common with the template is downloaded and stored only once. Returns the path to the mirror, or ""
+    if it couldn't be made, in which case we go on without it.
+    """
+    clone_url = 'https://%s@github.com/%s.git' % (github_token, template_full_name)
+    mirror_dir = os.path.abspath(os.path.join(out_dir, ".templates", template_full_name + ".git"))
+
+    async def never_collect_garbage():
+        # The clones depend on objects in the mirror that the mirror itself may no longer need, e.g., if the
+        # template's history is rewritten, or a branch is deleted. If git ever garbage-collected those, every
+        # clone would be silently corrupted, so it mustn't, neither automatically after a fetch, nor if
+        # somebody runs git gc by hand. For the same reason, we don't --prune branches that have gone away.
+        status, output = await run_git_async(["config", "gc.auto", "0"], mirror_dir)
+        if status == 0:
+            status, output = await run_git_async(["config", "gc.pruneExpire", "never"], mirror_dir)
+        return status, output
+
+    async def mirror():
+        if os.path.isdir(mirror_dir):
+            status, output = await never_collect_garbage()
+            if status == 0:
+                status, output = await run_git_async(["fetch", "--quiet", clone_url, "+refs/heads/*:refs/heads/*",
+                                                      "+refs/tags/*:refs/tags/*"], mirror_dir)
+            return status, output
+        os.makedirs(os.path.dirname(mirror_dir), exist_ok=True)
+        status, output = await run_git_async(["clone", "--quiet", "--mirror", clone_url, mirror_dir], out_dir)
+        if status == 0:
+            status, output = await never_collect_garbage()
+        if status == 0:
+            # we always fetch with the token, as above, so the mirror needn't keep it
+            status, output = await run_git_async(["remote", "set-url", "origin",
+                                                  'https://github.com/%s.git' % template_full_name], mirror_dir)
+        return status, output
+
+    status, output = run_scanner_coroutine(mirror())
+    if status != 0:
+        print("Couldn't mirror template %s, so the clones won't share its objects: %s"
+              % (template_full_name, output.strip()))
+        return ""
+    print("Mirrored template %s" % template_full_name)
+    return mirror_dir
+
+
+def use_relative_alternates(repo_dir: str):
+    """
+    git --reference records where the shared objects are with an absolute path. We rewrite it as a path
+    relative to the clone's own objects, which git also understands, so the whole --out directory, mirror
+    and all, can be moved or copied elsewhere and still work.
+    """
+    objects_dir = os.path.join(repo_dir, ".git", "objects")
+    alternates_file_name = os.path.join(objects_dir, "info", "alternates")
+    if not os.path.exists(alternates_file_name):
+        return
+    with open(alternates_file_name, 'r') as file:
+        alternates = [line.strip() for line in file if line.strip()]
+    with open(alternates_file_name, 'w') as file:
+        for alternate in alternates:
+            file.write(os.path.relpath(alternate, objects_dir) + "\n")
+
+
+def load_manifest() -> dict:
     try:
-        os.makedirs(out_dir)
-    except OSError:
-        pass  # directory already exists
+        with open(manifest_file_name, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
 
-    os.chdir(out_dir)
 
-# specific clone instructions here:
-# https://github.com/blog/1270-easier-builds-and-deployments-using-git-over-https-and-oauth
+def save_manifest(manifest: dict):
+    # written to the side and then renamed, so an interrupted run never leaves half a manifest behind
+    with open(manifest_file_name + ".tmp", 'w') as file:
+        file.write(dict_to_pretty_json(manifest))
+    os.replace(manifest_file_name + ".tmp", manifest_file_name)
 
-for repo in filtered_repo_list:
+
+def repo_is_unchanged(repo: dict, manifest: dict) -> bool:
+    entry = manifest.get(repo['name'])
+    return entry is not None and entry['pushed_at'] == repo.get('pushed_at') and \
+        os.path.isdir(os.path.join(out_dir, repo['name'], '.git'))
+
+
+async def sync_repo_async(repo: dict, mirror_dir: str, semaphore: asyncio.Semaphore) -> dict:
+    """
+    Clones one repo into out_dir or, with --sync, updates it if it's already there. If there's a mirror_dir
+    (see prepare_template_mirror), a new clone shares its objects, so only what the students wrote is
+    downloaded. (An update only fetches what the clone doesn't have already, either way.) Returns a dict with its
+    'name', whether it worked ('ok'), what we did ('action', either 'cloned' or 'updated'), how long it took
+    ('seconds'), the repo's 'pushed_at' and resulting 'head_sha', and if it didn't work, git's complaint
+    ('error').
+    """
+    # specific clone instructions here:
+    # https://github.com/blog/1270-easier-builds-and-deployments-using-git-over-https-and-oauth
     clone_url = 'https://%s@github.com/%s.git' % (github_token, repo['full_name'])
     safe_clone_url = 'https://github.com/%s.git' % repo['full_name']
+    repo_dir = os.path.join(out_dir, repo['name'])
+
+    async with semaphore:
+        start_time = time.time()
+        if use_sync and os.path.isdir(os.path.join(repo_dir, '.git')):
+            action = 'updated'
+            # We fetch from the URL with the token, rather than from origin, which with --safe doesn't have it,
+            # but into origin's branches all the same, so the local branch can be fast-forwarded to its upstream.
+            # If somebody's committed to the local branch, the fast-forward fails, and we leave it alone.
+            status, output = await run_git_async(["fetch", "--quiet", "--prune", clone_url,
+                                                  "+refs/heads/*:refs/remotes/origin/*"], repo_dir)
+            if status == 0:
+                status, output = await run_git_async(["merge", "--ff-only", "--quiet", "@{upstream}"], repo_dir)
+        else:
+            action = 'cloned'
+            reference = ["--reference-if-able", mirror_dir] if mirror_dir else []
+            status, output = await run_git_async(["clone", "--quiet"] + reference + [clone_url, repo['name']],
+                                                 out_dir)
+            if status == 0 and mirror_dir:
+                use_relative_alternates(repo_dir)
+            if status == 0 and use_safe_clone:
+                # Now, we set things up so push and pull will work, but we're *not* leaving the GitHub key in
+                # place, since that makes these repos too dangerous to share. If you've got ssh keys set up with
+                # GitHub, then push and pull will still work. The clone already set up the branch to track
+                # origin, so pointing origin somewhere else is all it takes.
+                status, output = await run_git_async(["remote", "set-url", "origin", safe_clone_url], repo_dir)
+
+        head_sha = None
+        if status == 0:
+            # an empty repo doesn't have a head commit, which isn't an error
+            head_status, head_output = await run_git_async(["rev-parse", "--verify", "--quiet", "HEAD"], repo_dir)
+            if head_status == 0:
+                head_sha = head_output.strip()
+
+    result = {'name': repo['name'], 'ok': status == 0, 'action': action, 'seconds': time.time() - start_time,
+              'pushed_at': repo.get('pushed_at'), 'head_sha': head_sha}
+    if status != 0:
+        # git says what went wrong on its "fatal:" line, possibly followed by advice we don't need
+        lines = [line for line in output.strip().splitlines() if line.startswith(('fatal:', 'error:'))] or \
+            output.strip().splitlines()
+        result['error'] = lines[0] if lines else "git exited with status %d" % status
+    return result
+
+
+def sync_all(repos: List[dict], manifest: dict, mirror_dir: str) -> List[dict]:
+    """
+    Clones (or updates) all the repos, num_jobs at a time, reporting on each one as it finishes and
+    noting it in the manifest. Returns a list of the results (see sync_repo_async) for the ones that failed.
+    """
+    async def sync_stage(key, repo, semaphore):
+        return await sync_repo_async(repo, mirror_dir, semaphore)
+
+    start_time = time.time()
+    failures = []
+    num_done = 0
+    num_actions = {'cloned': 0, 'updated': 0}
+    for _, result in iter_pipeline({repo['full_name']: repo for repo in repos},
+                                   [PipelineStage(sync_stage, num_jobs)]):
+        num_done = num_done + 1
+        if result['ok']:
+            print("[%d/%d] %s %s (%.1fs)" % (num_done, len(repos), result['action'], result['name'],
+                                             result['seconds']))
+            num_actions[result['action']] = num_actions[result['action']] + 1
+            manifest[result['name']] = {'pushed_at': result['pushed_at'], 'head_sha': result['head_sha']}
+        else:
+            print("[%d/%d] %s FAILED: %s" % (num_done, len(repos), result['name'], result['error']))
+            failures.append(result)
+
+    elapsed = time.time() - start_time
+    num_succeeded = num_done - len(failures)
+    print("Cloned %d and updated %d repos in %.1f seconds (%.1f repos per minute)"
+          % (num_actions['cloned'], num_actions['updated'], elapsed, 60 * num_succeeded / max(elapsed, 0.001)))
+    return failures
+
+
+# When syncing, we want to know about every push, so we don't trust a recently checked repo listing
+# without checking it again.
+filtered_repo_list = query_matching_repos(github_organization, github_prefix, github_token,
+                                          max_age=0 if use_sync else None, stale_age=0 if use_sync else None)
+print("%d repos found for %s/%s" % (len(filtered_repo_list), github_organization, github_prefix))
+
+# before we start getting any repos, we need a directory to put them
+os.makedirs(out_dir, exist_ok=True)
+
+if template_name == "auto":
+    template_name = find_template_name(filtered_repo_list)
+    if not template_name:
+        print("No template found for %s/%s, so the clones won't share objects" % (github_organization, github_prefix))
+template_mirror_dir = prepare_template_mirror(template_name) if template_name else ""
+
+clone_manifest = load_manifest()
+if use_sync:
+    changed_repo_list = [repo for repo in filtered_repo_list if not repo_is_unchanged(repo, clone_manifest)]
+    print("%d repos unchanged since the last sync" % (len(filtered_repo_list) - len(changed_repo_list)))
+else:
+    changed_repo_list = filtered_repo_list
+
+try:
+    failed_repos = sync_all(changed_repo_list, clone_manifest, template_mirror_dir)
+finally:
+    # even if we're interrupted, we remember what we got done
+    save_manifest(clone_manifest)
 
-    if use_safe_clone:
-        # Steps to take, per docs above:
-        #
-        # mkdir foo
-        # cd foo
-        # git init
-        # git pull https://<token>@github.com/username/bar.git
-
-        os.mkdir(repo['name'])
-        os.chdir(repo['name'])
-        subprocess.call(["git", "init"])
-        subprocess.call(["git", "pull", clone_url])
-
-        # Now, we set things up so push and pull will work, but we're *not* putting the GitHub key in place,
-        # since that makes these repos too dangerous to share. If you've got ssh keys set up with GitHub,
-        # then push and pull will still work.
-
-        subprocess.call(["git", "remote", "add", "origin", safe_clone_url])
-        subprocess.call(["git", "fetch"])
-        subprocess.call(["git", "branch", "--set-upstream-to=origin/master", "master"])
-        os.chdir('..')
-    else:
-        subprocess.call(["git", "clone", clone_url])
+if failed_repos:
+    print("%d repos failed to %s:" % (len(failed_repos), "sync" if use_sync else "clone"))
+    for failure in sorted(failed_repos, key=lambda failure: failure['name'].lower()):
+        print("    %s: %s" % (failure['name'], failure['error']))
+    exit(1)
@@ -31,12 +31,18 @@ parser.add_argument('--prefix',
                     nargs=1,
                     default=[default_prefix],
                     help='Prefix on projects to match (default: match all projects)')
+parser.add_argument('--graphql',
+                    action="store_true",
+                    default=False,
+                    help="fetch head commits and check suites with GitHub's GraphQL API, a hundred repos per "
+                         "request, falling back to REST for anything missing (default: REST only)")
 
 args = parser.parse_args()
 
 github_prefix = args.prefix[0]
 github_organization = args.org[0]
 github_token = args.token[0]
+use_graphql = args.graphql
 
 output_filename = args.output[0]
 
@@ -54,26 +60,21 @@ repo_seen = {}
 
 results = []
 
-print("Loading refs...")
+print("Loading head commits and check-suite data...")
 
-ref_urls = [{'key': repo['full_name'], 'url': "repos/%s/git/refs" % repo['full_name']}
-            for repo in filtered_repo_list
-            if desired_user(github_prefix, all_ignore_list, repo['name'])]
 
-refs = parallel_get_github_endpoint(ref_urls, github_token)
-
-print("Loading check-suite data...")
-
-desired_refs = [{'key': k, 'url': "repos/%s/commits/%s/check-suites" % (k, refs[k]['body'][0]['object']['sha'])}
-                for k in refs.keys()
-                if refs[k]['body'][0]['ref'] == 'refs/heads/master']
-
-check_responses = parallel_get_github_endpoint(desired_refs, github_token)
+# with REST, each repo's check suites are requested as soon as we know the head of its default branch, the heads
+# of repos that nobody has pushed to since the last run come from the cache, and so do check suites that had
+# finished; with GraphQL, one request covers a hundred repos
+heads = fetch_repo_heads([repo for repo in filtered_repo_list
+                          if desired_user(github_prefix, all_ignore_list, repo['name'])],
+                         github_token, use_graphql=use_graphql)
+# empty repos have no head commit, and thus nothing to report
+check_responses = {repo_name: head for (repo_name, head) in heads.items() if head['head_sha'] is not None}
 
 for repo_name in sorted(check_responses.keys()):
-    tmp_response = check_responses[repo_name]['body']
-    if 'check_suites' in tmp_response and len(tmp_response['check_suites']) > 0:
-        check_suites_response = tmp_response['check_suites'][0]
+    check_suites_response = check_responses[repo_name]['check_suite']
+    if check_suites_response is not None:
         conclusion = check_suites_response['conclusion']
         response_sha = check_suites_response['head_sha']
         if response_sha not in sha_seen:
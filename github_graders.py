@@ -4,6 +4,7 @@
 # https://www.apache.org/licenses/LICENSE-2.0
 
 import argparse
+import functools
 import random
 import pandas as pd
 from github_config import *
@@ -44,6 +45,11 @@ parser.add_argument('--ignore',
                     nargs=1,
                     default=[""],
                     help="string pattern in group names to ignore, e.g., STAFF (no default)")
+parser.add_argument('--graphql',
+                    action="store_true",
+                    default=False,
+                    help="fetch team information with GitHub's GraphQL API, falling back to REST if the results "
+                         "are incomplete (default: REST only)")
 
 args = parser.parse_args()
 
@@ -53,6 +59,7 @@ github_token = args.token[0]
 student_file_name = args.students[0]
 use_teams = args.teams
 ignore_str = args.ignore[0]
+use_graphql = args.graphql
 
 # Python3's parametric type hints are ... a thing.
 T = TypeVar('T')
@@ -127,7 +134,7 @@ filtered_repo_list = [x for x in query_matching_repos(github_organization, githu
                       if desired_user(github_prefix, all_ignore_list, x['name'], ignore_str)]
 
 if use_teams:
-    team_info = fetch_team_infos(filtered_repo_list, github_token, True)
+    team_info = fetch_team_infos(filtered_repo_list, github_token, True, use_graphql=use_graphql)
 else:
     team_info = {}
 
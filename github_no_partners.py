@@ -41,6 +41,11 @@ parser.add_argument('--min_team_size',
                     nargs=1,
                     default=["2"],
                     help="minimum team size (default: 2)")
+parser.add_argument('--graphql',
+                    action="store_true",
+                    default=False,
+                    help="fetch team information with GitHub's GraphQL API, falling back to REST if the results "
+                         "are incomplete (default: REST only)")
 
 args = parser.parse_args()
 
@@ -50,6 +55,7 @@ github_token = args.token[0]
 student_file_name = args.students[0]
 ignore_str = args.ignore[0]
 min_team_size = int(args.min_team_size[0])
+use_graphql = args.graphql
 
 df_students = {}  # will replace below
 df_students_success = False
@@ -111,7 +117,7 @@ all_ignore_list = ignore_list + grader_list
 filtered_repo_list = [x for x in query_matching_repos(github_organization, github_prefix, github_token)
                       if desired_user(github_prefix, all_ignore_list, x['name'], ignore_str)]
 
-team_info = fetch_team_infos(filtered_repo_list, github_token, True)
+team_info = fetch_team_infos(filtered_repo_list, github_token, True, use_graphql=use_graphql)
 
 gid_to_repo = {}
 duplicates = {}
@@ -39,7 +39,7 @@ def main():
     
     
     endpoint = "orgs/{org}/teams".format(org=github_org)
-    result = get_github_endpoint(endpoint, github_token)
+    result = get_github_endpoint_paged_list(endpoint, github_token, verbose=False)
     print("result =", dict_to_pretty_json(result))        
 
 
@@ -4,6 +4,8 @@
 # https://www.apache.org/licenses/LICENSE-2.0
 
 import argparse
+import csv
+import io
 from github_config import *
 from github_scanner import *
 
@@ -20,56 +22,262 @@ parser.add_argument('--prefix',
                     nargs=1,
                     default=[default_prefix],
                     help='Prefix on projects to match (default: match all projects)')
+parser.add_argument('--sorted',
+                    action="store_true",
+                    default=False,
+                    help="print repos in alphabetical order (default: print each repo as soon as its status arrives)")
+parser.add_argument('--format',
+                    nargs=1,
+                    default=["text"],
+                    choices=["text", "json", "csv"],
+                    help="output format: text, json, or csv (default: text)")
+parser.add_argument('--graphql',
+                    action="store_true",
+                    default=False,
+                    help="fetch head commits and check suites with GitHub's GraphQL API, a hundred repos per "
+                         "request, falling back to REST for anything missing (default: REST only)")
+parser.add_argument('--watch',
+                    action="store_true",
+                    default=False,
+                    help="keep scanning until interrupted, only rechecking repos that might have changed")
+parser.add_argument('--interval',
+                    nargs=1,
+                    type=int,
+                    default=[60],
+                    help="with --watch, seconds between scans, unless GitHub asks us to wait longer (default: 60)")
+parser.add_argument('--output',
+                    nargs=1,
+                    default=[""],
+                    help="with --watch, a file to rewrite with the results after every scan "
+                         "(default: redraw the terminal)")
 
 args = parser.parse_args()
 
 github_prefix = args.prefix[0]
 github_organization = args.org[0]
 github_token = args.token[0]
+use_sorted = args.sorted
+output_format = args.format[0]
+use_graphql = args.graphql
+use_watch = args.watch
+watch_interval = args.interval[0]
+output_filename = args.output[0]
 
-filtered_repo_list = query_matching_repos(github_organization, github_prefix, github_token)
-print("%d matching repos found for %s/%s" % (len(filtered_repo_list), github_organization, github_prefix))
+# anything other than text is meant for other programs to read, so we don't clutter it with progress reports,
+# and in watch mode, we're redrawing everything every time anyway
+verbose = output_format == "text" and not use_watch
 
-conclusions = {'MISSING': 0}
-num_repos = 0
-num_missing = 0
 all_ignore_list = default_grader_list + default_grader_ignore_list
 
-for repo in sorted(filtered_repo_list, key=lambda d: str.lower(d['full_name'])):
-    repo_name = repo['full_name']
-    short_name = repo['name']
-    if not desired_user(github_prefix, all_ignore_list, short_name):
-        continue
+csv_fields = ['repo', 'name', 'default_branch', 'head_sha', 'status', 'conclusion', 'created_at']
+
+# GitHub takes a little while to start the checks on a commit, so in watch mode, a repo without any checks
+# that was pushed to less than this many seconds ago might still get some
+MISSING_CHECKS_GRACE_PERIOD = 600
+
+
+def query_desired_repos(max_age: float = None) -> dict:
+    filtered_repo_list = query_matching_repos(github_organization, github_prefix, github_token, verbose, max_age,
+                                              max_age)
+    if verbose:
+        print("%d matching repos found for %s/%s" % (len(filtered_repo_list), github_organization, github_prefix))
+
+    return {repo['full_name']: repo
+            for repo in filtered_repo_list
+            if desired_user(github_prefix, all_ignore_list, repo['name'])}
+
+
+def iter_heads(repo_list: List[dict]):
+    """
+    Yields (full_name, head) for each repo, as in iter_repo_heads. With REST, each repo shows up as soon as
+    its answers are in. With GraphQL, a hundred repos' answers arrive together, so we just wait for all of them.
+    """
+    if use_graphql:
+        return iter(fetch_repo_heads(repo_list, github_token, verbose, use_graphql=True).items())
+    return iter_repo_heads(repo_list, github_token, verbose)
+
+
+def status_row(repo: dict, head: dict) -> dict:
+    check_suite = head['check_suite']
+    return {
+        'repo': repo['full_name'],
+        'name': repo['name'],
+        'default_branch': head['default_branch'],
+        'head_sha': head['head_sha'],
+        'status': check_suite['status'] if check_suite else None,
+        'conclusion': check_suite['conclusion'] if check_suite else 'MISSING',
+        'created_at': check_suite['created_at'] if check_suite else None
+    }
+
+
+def text_line(row: dict) -> str:
+    if row['conclusion'] == 'MISSING':
+        return "MISSING CHECKS: " + row['repo']
+    else:
+        return "%s: %s (%s, %s)" % (row['name'], row['conclusion'], localtime_from_iso_datestr(row['created_at']),
+                                    row['head_sha'][0:7])
+
+
+def count_conclusions(rows: List[dict]) -> dict:
+    conclusions = {'MISSING': 0}
+    for row in rows:
+        # a check suite that's still running doesn't have a conclusion yet, which we count as 'None'
+        conclusion = str(row['conclusion'])
+        conclusions[conclusion] = conclusions.get(conclusion, 0) + 1
+    return conclusions
+
+
+def text_totals(rows: List[dict]) -> str:
+    conclusions = count_conclusions(rows)
+    return "\n".join(["Total repos scanned: %d" % len(rows)] +
+                     ["%s: %4d" % (key, conclusions[key]) for key in conclusions.keys()])
+
+
+def json_document(rows: List[dict]) -> str:
+    return dict_to_pretty_json({'repos': rows, 'totals': count_conclusions(rows)})
 
-    num_repos = num_repos + 1
 
-    # The GitHub API for getting the check status requires us to know
-    # the SHA1 hash for the commit we're checking.
+def csv_document(rows: List[dict]) -> str:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=csv_fields)
+    writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
 
-    # TODO: find a way to just name the HEAD of the master branch.
-    ref_response = get_github_endpoint_paged_list("repos/%s/git/refs" % repo_name, github_token)
-    head_sha = ref_response[0]['object']['sha']
 
-    # print("repo: %s (%s)" % (repo_name, head_sha))
+def sorted_rows(rows, repo_names: List[str]):
+    """
+    Given rows arriving in any order, yields them in alphabetical order, each one as soon as every row
+    that comes before it has arrived.
+    """
+    order = sorted(repo_names, key=str.lower)
+    waiting = {}
+    next_index = 0
+    for row in rows:
+        waiting[row['repo']] = row
+        while next_index < len(order) and order[next_index] in waiting:
+            yield waiting.pop(order[next_index])
+            next_index = next_index + 1
 
-    tmp_response = get_github_endpoint("repos/%s/commits/%s/check-suites" % (repo_name, head_sha), github_token)
 
-    if 'check_suites' in tmp_response and len(tmp_response['check_suites']) > 0:
-        check_suites_response = tmp_response['check_suites'][0]
-        conclusion = check_suites_response['conclusion']
-        response_sha = check_suites_response['head_sha'][0:7]
-        timestamp = localtime_from_iso_datestr(check_suites_response['created_at'])
+def scan_once():
+    desired_repos = query_desired_repos()
 
-        print("%s: %s (%s, %s)" % (short_name, conclusion, timestamp, response_sha))
+    csv_writer = csv.DictWriter(sys.stdout, fieldnames=csv_fields)
+    if output_format == "csv":
+        csv_writer.writeheader()
 
-        if conclusion in conclusions:
-            conclusions[conclusion] = conclusions[conclusion] + 1
-        else:
-            conclusions[conclusion] = 1
+    # Every repo's head commit and check suites are fetched in parallel, and each repo is reported as soon as
+    # its answers are in, so the first lines show up long before the slowest repo is done.
+    rows = (status_row(desired_repos[repo_name], head)
+            for (repo_name, head) in iter_heads(list(desired_repos.values())))
+    if use_sorted:
+        rows = sorted_rows(rows, list(desired_repos.keys()))
+
+    all_rows = []
+    for row in rows:
+        all_rows.append(row)
+        if output_format == "csv":
+            csv_writer.writerow(row)
+            sys.stdout.flush()
+        elif output_format == "text":
+            print(text_line(row))
+
+    if output_format == "json":
+        print(json_document(all_rows))
+    elif output_format == "text":
+        print(text_totals(all_rows))
+
+
+def write_in_place(file_name: str, contents: str):
+    # written to the side and then renamed, so whoever is reading the file never sees half of it
+    temp_file_name = file_name + ".tmp"
+    with open(temp_file_name, 'w') as file:
+        file.write(contents)
+    os.replace(temp_file_name, file_name)
+
+
+def show_watch_results(rows: List[dict], next_scan: float):
+    if output_format == "json":
+        contents = json_document(rows) + "\n"
+    elif output_format == "csv":
+        contents = csv_document(rows)
+    else:
+        contents = "\n".join([text_line(row) for row in rows] + [text_totals(rows)]) + "\n"
+
+    if output_filename:
+        write_in_place(output_filename, contents)
+        return
+
+    budget = rate_limit_state.get('core', {})
+    # clear the terminal, and start again from the top
+    sys.stdout.write("\033[H\033[J")
+    sys.stdout.write(contents)
+    sys.stdout.write("\nUpdated %s, next scan at %s, API requests remaining: %s / %s (Ctrl-C to stop)\n"
+                     % (localtime_from_timestamp(time.time()), localtime_from_timestamp(next_scan),
+                        budget.get('remaining'), budget.get('limit')))
+    sys.stdout.flush()
+
+
+def is_settled(entry: dict) -> bool:
+    """
+    In watch mode, says whether a repo's status can only change if somebody pushes to it: either its checks
+    have finished, or it doesn't have any (e.g., it's empty, or the student deleted the workflow).
+    """
+    row = entry['row']
+    if row['status'] == 'completed':
+        return True
+    elif row['conclusion'] == 'MISSING':
+        return entry['pushed_at'] is None or \
+            time.time() - iso8601.parse_date(entry['pushed_at']).timestamp() > MISSING_CHECKS_GRACE_PERIOD
     else:
-        print("MISSING CHECKS: " + repo_name)
-        conclusions['MISSING'] = conclusions['MISSING'] + 1
+        return False
+
+
+def rescan(state: dict, dirty_repos: set):
+    # we want to see what's changed since the last scan, not what we remembered during it
+    forget_memoized_responses()
+    desired_repos = query_desired_repos(max_age=0)
+
+    stale_repos = [repo for repo in desired_repos.values()
+                   if repo['full_name'] not in state
+                   or repo['full_name'] in dirty_repos
+                   or state[repo['full_name']]['pushed_at'] != repo.get('pushed_at')
+                   or not is_settled(state[repo['full_name']])]
+
+    for repo_name, head in iter_heads(stale_repos):
+        state[repo_name] = {'pushed_at': desired_repos[repo_name].get('pushed_at'),
+                            'row': status_row(desired_repos[repo_name], head)}
+
+    for repo_name in [repo_name for repo_name in state.keys() if repo_name not in desired_repos]:
+        del state[repo_name]
+
+
+def watch():
+    """
+    Scans over and over again, remembering each repo's status in between. A repo is only checked again if
+    somebody's pushed to it or it isn't settled yet (see is_settled); everything else stays as it was.
+    Rechecks mostly hit our caches, or at worst get "304 Not Modified" from GitHub, which is free.
+    """
+    state = {}
+    while True:
+        # Every pass checks the repo listing (one HEAD request, whose ETag changes with any push) and compares
+        # each repo's pushed_at, since that's the only reliable way to notice a push. The organization's event
+        # stream can lag by hours, so it's only an extra hint about what's changed, and it's where GitHub
+        # tells us how often it wants to be polled.
+        dirty_repos = poll_org_push_events(github_organization, github_token, verbose)
+        rescan(state, dirty_repos or set())
+
+        next_scan = time.time() + poll_interval(watch_interval)
+        show_watch_results([state[repo_name]['row'] for repo_name in sorted(state.keys(), key=str.lower)],
+                           next_scan)
+        time.sleep(max(0.0, next_scan - time.time()))
+
 
-print("Total repos scanned: %d" % num_repos)
-for key in conclusions.keys():
-    print("%s: %4d" % (key, conclusions[key]))
+if use_watch:
+    try:
+        watch()
+    except KeyboardInterrupt:
+        print("")
+else:
+    scan_once()
@@ -14,59 +14,467 @@ import sys
 import os
 import json
 import re
-import functools
-from typing import List
+import time
+import random
+import sqlite3
+import threading
+import atexit
+import urllib.parse
+from collections import namedtuple
+from typing import List, Optional
 from datetime import datetime, timezone
-from requests.models import Response
-import requests
 import asyncio
-from aiohttp import ClientSession, ClientResponse
-
-scanner_cache = {}
+from aiohttp import ClientSession, ClientError, TCPConnector
+
+# Everything we cache lives in a single SQLite database in the current working directory:
+# - repo_listings: one row per organization, with the ETag of its repo listing
+# - repos: one row per repository, indexed by name (so prefix queries are range scans) and by pushed_at
+# - responses: individual GET responses, keyed by URL, along with the ETag / Last-Modified validators
+#   that GitHub sent with them. We replay those validators on the next request for the same URL, and if
+#   GitHub says "304 Not Modified", we serve the body from here. 304s don't count against the rate limit.
+# - derived: things we've worked out about a repo that can only change when somebody pushes to it (its
+#   head commit), along with the repo's pushed_at when we worked them out. Until somebody pushes to the
+#   repo again, we don't ask again.
+# - completed_checks: check suites and check runs for a commit, once every one of them has finished. A
+#   finished check never changes, so once it's here, we never ask GitHub about that commit again.
+# - webhook_receivers: when we last heard from a webhook receiver for each organization (see below).
+# All updates are row-level, so refreshing one thing never rewrites everything else.
+store_file_name = ".github-classroom-utils.sqlite3"
+_store_connection = None
+_store_lock = threading.RLock()
+
+# Likewise, the in-memory state below that's shared by everything that talks to GitHub (the rate-limit
+# budget, poll intervals, parsed and memoized responses) may be used from more than one thread at once, e.g.,
+# while refresh_repo_listing_in_background is running, so it's only touched while holding this lock.
+_state_lock = threading.RLock()
+
+_store_schema = """
+CREATE TABLE IF NOT EXISTS repo_listings (
+    org TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS repos (
+    org TEXT NOT NULL,
+    name TEXT NOT NULL,
+    pushed_at TEXT,
+    body TEXT NOT NULL,
+    PRIMARY KEY (org, name)
+);
+CREATE INDEX IF NOT EXISTS repos_by_pushed_at ON repos (org, pushed_at);
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,
+    last_modified TEXT NOT NULL,
+    link TEXT NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS derived (
+    repo TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    pushed_at TEXT NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (repo, kind)
+);
+CREATE TABLE IF NOT EXISTS completed_checks (
+    repo TEXT NOT NULL,
+    sha TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (repo, sha, kind)
+);
+CREATE TABLE IF NOT EXISTS webhook_receivers (
+    org TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL
+);
+"""
+
+# Upper bound on how many GitHub requests we'll have outstanding at any one time. GitHub has "secondary"
+# rate limits that trip when a client opens too many simultaneous connections, so rather than firing off
+# every request at once, we keep a steady stream of at most this many in flight.
+DEFAULT_MAX_IN_FLIGHT = 16
+
+# The scanner's HTTP client: one aiohttp session, and thus one pool of keep-alive connections, shared by
+# every request we make for the life of the process, whether it comes from a synchronous call like
+# get_github_endpoint or from a big parallel fan-out. Synchronous calls run the same async code on our
+# own event loop, so TCP and TLS handshakes happen once per connection, not once per request or per stage.
+# (aiohttp sessions belong to a single event loop, so if you're using the async API from your own
+# loop, that loop gets a session of its own.)
+CONNECTION_POOL_SIZE = 32
+_client_loop = None
+_client_sessions = {}
+
+# What we keep of an HTTP response once we've read its body.
+GitHubResponse = namedtuple('GitHubResponse', ['status', 'headers', 'body'])
+
+# Our view of the GitHub API budget, one entry per rate-limit "resource" (core, search, graphql), updated
+# from the X-RateLimit-* headers on every response we see. Every request consults this before it's sent,
+# so a long scan slows down as the budget runs low and sleeps through the reset when the budget is gone,
+# rather than running into a wall of 403 errors.
+rate_limit_state = {}
+
+# Once the remaining budget drops below this fraction of the limit, we start spacing requests out evenly
+# over the time left until the reset, so the budget lasts the whole window.
+RATE_LIMIT_LOW_WATER_FRACTION = 0.1
+
+# Some endpoints, notably the events APIs, come with an X-Poll-Interval header, which is how many seconds
+# GitHub would like us to wait before asking again. We remember the latest one for each URL.
+poll_intervals = {}
+
+# Retry policy for transient failures (5xx hiccups, secondary rate limits, dropped connections). Each retry
+# waits a random amount of time up to an exponentially growing cap ("full jitter"), so a burst of parallel
+# requests that fail together don't all come back together.
+RETRY_MAX_ATTEMPTS = 6
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
 
 
 def dict_to_pretty_json(d: dict) -> str:
     return json.dumps(d, sort_keys=True, indent=2)
 
 
-def load_cache(github_organization: str, verbose: bool = True):
-    if github_organization in scanner_cache:
-        return
+def github_store() -> sqlite3.Connection:
+    """
+    Returns our connection to the cache database, opening it (and creating the tables) on first use.
+    The connection may be shared across threads, so hold _store_lock while using it.
+    """
+    global _store_connection
 
+    with _store_lock:
+        if _store_connection is None:
+            connection = sqlite3.connect(store_file_name, check_same_thread=False)
+            # write-ahead logging lets several of our scripts share the cache without tripping over each other
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(_store_schema)
+            _store_connection = connection
+
+        return _store_connection
+
+
+def _import_legacy_cache(github_organization: str, verbose: bool = True):
+    """
+    Earlier versions of these tools kept the repo list for each organization in a big JSON file. If we
+    find one and don't have anything better, we'll start from that rather than rescanning GitHub.
+    """
     cache_name = ".github-classroom-utils." + github_organization + ".json"
+    if not os.path.isfile(cache_name) or repo_listing_etag(github_organization) != "":
+        return
+
     try:
-        if os.path.isfile(cache_name) and os.access(cache_name, os.R_OK):
-            with open(cache_name, 'r') as file:
-                data = json.loads(file.read())
-                scanner_cache[github_organization] = data
-                if verbose:
-                    print("Restored cache: " + github_organization)
+        with open(cache_name, 'r') as file:
+            data = json.loads(file.read())
+        store_repo_listing(github_organization, data['ETag'], data['Contents'])
+        if verbose:
+            print("Imported legacy cache: " + cache_name)
 
     except Exception as e:
-        print("Unexpected error loading cache: " + cache_name)
-        print(e)
-        exit(1)
+        if verbose:
+            print("Unexpected error importing legacy cache: " + cache_name)
+            print(e)
 
 
-def store_cache(github_organization: str, verbose: bool = True):
-    if github_organization not in scanner_cache:
-        if verbose:
-            print("Warning: nothing in cache for " + github_organization + ". Nothing to persist to disk.")
+def repo_listing_etag(github_organization: str) -> str:
+    """
+    Returns the ETag of the cached repo listing for the organization, or an empty string if there isn't one.
+    """
+    with _store_lock:
+        row = github_store().execute("SELECT etag FROM repo_listings WHERE org = ?",
+                                     (github_organization,)).fetchone()
+    return row[0] if row else ""
+
+
+def repo_listing_age(github_organization: str) -> float:
+    """
+    Returns how many seconds it's been since we last checked that the cached repo listing for the
+    organization was current (or updated it), or infinity if we don't have one.
+    """
+    with _store_lock:
+        row = github_store().execute("SELECT updated_at FROM repo_listings WHERE org = ?",
+                                     (github_organization,)).fetchone()
+    return time.time() - row[0] if row else float('inf')
+
+
+def note_repo_listing_current(github_organization: str):
+    with _store_lock:
+        db = github_store()
+        with db:
+            db.execute("UPDATE repo_listings SET updated_at = ? WHERE org = ?", (time.time(), github_organization))
+
+
+def store_repo_listing(github_organization: str, etag: str, repo_list: List[dict], complete: bool = True) -> dict:
+    """
+    Updates the cached repo listing for the organization. Rows for repos we already knew about are
+    upserted in place. If complete is True, repo_list is the whole listing, so any repos that are no
+    longer present are deleted; otherwise, repo_list only has new or changed repos to merge in.
+    Returns a dict with the names of the repos that were 'added' and 'removed'.
+    """
+    with _store_lock:
+        db = github_store()
+        with db:
+            old_names = {row[0] for row in db.execute("SELECT name FROM repos WHERE org = ?",
+                                                      (github_organization,))}
+            new_names = {repo['name'] for repo in repo_list}
+            removed = sorted(old_names - new_names) if complete else []
+            db.executemany("DELETE FROM repos WHERE org = ? AND name = ?",
+                           [(github_organization, name) for name in removed])
+            db.executemany("INSERT OR REPLACE INTO repos (org, name, pushed_at, body) VALUES (?, ?, ?, ?)",
+                           [(github_organization, repo['name'], repo.get('pushed_at'), json.dumps(repo))
+                            for repo in repo_list])
+            db.execute("INSERT OR REPLACE INTO repo_listings (org, etag, updated_at) VALUES (?, ?, ?)",
+                       (github_organization, etag, time.time()))
+
+    return {'added': sorted(new_names - old_names), 'removed': removed}
+
+
+def load_repos(github_organization: str, github_repo_prefix: str = "", pushed_since: str = None) -> List[dict]:
+    """
+    Returns the cached repos for the organization whose names start with the given prefix, sorted by name.
+    If pushed_since is given (an ISO 8601 string, like GitHub's pushed_at), only repos pushed to after
+    that time are returned.
+    """
+    # a prefix match is a range scan over the primary key: every string that starts with the prefix
+    # sorts between the prefix itself and the prefix followed by the largest possible character
+    query = "SELECT body FROM repos WHERE org = ? AND name >= ? AND name < ?"
+    params = [github_organization, github_repo_prefix, github_repo_prefix + chr(0x10FFFF)]
+    if pushed_since is not None:
+        query = query + " AND pushed_at > ?"
+        params.append(pushed_since)
+    query = query + " ORDER BY name"
+
+    with _store_lock:
+        rows = github_store().execute(query, params).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def count_cached_repos(github_organization: str) -> int:
+    """
+    Returns how many repos we have cached for the organization.
+    """
+    with _store_lock:
+        return github_store().execute("SELECT COUNT(*) FROM repos WHERE org = ?",
+                                      (github_organization,)).fetchone()[0]
+
+
+def load_derived(repo: dict, kind: str):
+    """
+    Returns what we've previously stored with store_derived for this repo (one of the dicts from
+    query_matching_repos) under the given kind, or None if we don't have it, or if the repo has
+    been pushed to since then.
+    """
+    if not repo.get('pushed_at'):
+        return None
+
+    with _store_lock:
+        row = github_store().execute("SELECT body FROM derived WHERE repo = ? AND kind = ? AND pushed_at = ?",
+                                     (repo['full_name'], kind, repo['pushed_at'])).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def store_derived(repo: dict, kind: str, value):
+    """
+    Remembers something we've worked out about a repo, which stays valid until the repo's pushed_at changes.
+    """
+    if not repo.get('pushed_at') or value is None:
         return
 
-    cache_name = ".github-classroom-utils." + github_organization + ".json"
-    try:
-        with open(cache_name, 'w') as file:
-            # Pretty-printing the results, even though they're larger. Human-legibility may come in handy.
-            file.write(dict_to_pretty_json(scanner_cache[github_organization]))
+    with _store_lock:
+        db = github_store()
+        with db:
+            db.execute("INSERT OR REPLACE INTO derived (repo, kind, pushed_at, body) VALUES (?, ?, ?, ?)",
+                       (repo['full_name'], kind, repo['pushed_at'], json.dumps(value)))
 
-            if verbose:
-                print("Wrote cache for " + github_organization)
 
-    except Exception as e:
+def load_completed_checks(repo_name: str, sha: str, kind: str) -> Optional[dict]:
+    """
+    Returns the stored check-suites or check-runs response (kind is 'check-suites' or 'check-runs') for
+    the given commit of the given repo (its full_name), or None if we haven't seen all of them finish.
+    """
+    with _store_lock:
+        row = github_store().execute("SELECT body FROM completed_checks WHERE repo = ? AND sha = ? AND kind = ?",
+                                     (repo_name, sha, kind)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def store_completed_checks(repo_name: str, sha: str, kind: str, body: dict):
+    with _store_lock:
+        db = github_store()
+        with db:
+            db.execute("INSERT OR REPLACE INTO completed_checks (repo, sha, kind, body) VALUES (?, ?, ?, ?)",
+                       (repo_name, sha, kind, json.dumps(body)))
+
+
+def update_cached_repos(github_organization: str, repo_list: List[dict], removed_names: List[str] = []):
+    """
+    Upserts the given repos into the cached listing for the organization, and deletes the named ones,
+    without touching the listing's ETag. (So if we're wrong, the next full check of the listing will
+    notice that GitHub's ETag is different and bring us back in sync.)
+    """
+    with _store_lock:
+        db = github_store()
+        with db:
+            db.executemany("DELETE FROM repos WHERE org = ? AND name = ?",
+                           [(github_organization, name) for name in removed_names])
+            db.executemany("INSERT OR REPLACE INTO repos (org, name, pushed_at, body) VALUES (?, ?, ?, ?)",
+                           [(github_organization, repo['name'], repo.get('pushed_at'), json.dumps(repo))
+                            for repo in repo_list])
+
+
+# While a webhook receiver (see github_webhook_receiver.py) is running for an organization, it keeps our
+# cached listing of the organization's repos up to date, so nobody needs to ask GitHub whether it's current.
+# The receiver checks in every WEBHOOK_HEARTBEAT_INTERVAL seconds, and if we haven't heard from it in twice
+# that long, we assume it's gone, and go back to asking GitHub.
+WEBHOOK_HEARTBEAT_INTERVAL = 60
+
+
+def note_webhook_heartbeat(github_organization: str):
+    with _store_lock:
+        db = github_store()
+        with db:
+            db.execute("INSERT OR REPLACE INTO webhook_receivers (org, seen_at) VALUES (?, ?)",
+                       (github_organization, time.time()))
+
+
+def webhook_receiver_is_live(github_organization: str) -> bool:
+    with _store_lock:
+        row = github_store().execute("SELECT seen_at FROM webhook_receivers WHERE org = ?",
+                                     (github_organization,)).fetchone()
+    return row is not None and row[0] > time.time() - 2 * WEBHOOK_HEARTBEAT_INTERVAL
+
+
+def _iso_timestamp(timestamp) -> Optional[str]:
+    # push events give repo timestamps in seconds since the epoch, everything else gives ISO 8601 strings
+    if isinstance(timestamp, (int, float)):
+        return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return timestamp
+
+
+def apply_webhook_event(event_type: str, payload: dict, verbose: bool = True) -> Optional[str]:
+    """
+    Updates the cache to reflect a GitHub webhook delivery (event_type is the X-GitHub-Event header, and
+    payload is the parsed body). We handle 'push', 'repository', and 'check_suite' events, and ignore
+    anything else. (Teams aren't cached beyond their ETags, so 'membership' events don't need handling.)
+    Returns the organization the event was about, or None if it was ignored.
+    """
+    if 'repository' in payload:
+        github_organization = payload['repository']['full_name'].split('/')[0]
+    elif 'organization' in payload:
+        github_organization = payload['organization']['login']
+    else:
+        return None
+
+    if event_type == 'push':
+        # keep everything we know about the repo, except that it's just been pushed to, which invalidates
+        # whatever we worked out about it before; if it was a push to the default branch, we know the new head
+        repo = payload['repository']
+        cached = load_repos(github_organization, repo['name'])
+        cached = [r for r in cached if r['name'] == repo['name']]
+        if not cached:
+            return None
+        updated = dict(cached[0], pushed_at=_iso_timestamp(repo['pushed_at']))
+        update_cached_repos(github_organization, [updated])
+        if payload['ref'] == 'refs/heads/' + repo['default_branch'] and not payload.get('deleted'):
+            store_derived(updated, 'head', {'default_branch': repo['default_branch'], 'head_sha': payload['after']})
         if verbose:
-            print("Unexpected error writing cache: " + cache_name)
-            print(e)
+            print("push: %s (%s)" % (repo['full_name'], payload['ref']))
+
+    elif event_type == 'repository':
+        repo = dict(payload['repository'],
+                    created_at=_iso_timestamp(payload['repository'].get('created_at')),
+                    pushed_at=_iso_timestamp(payload['repository'].get('pushed_at')))
+        # 'transferred' is delivered to the repo's new owner, so for us, it's a repo arriving, like 'created'
+        if payload['action'] == 'deleted':
+            update_cached_repos(github_organization, [], [repo['name']])
+        else:
+            renamed_from = payload.get('changes', {}).get('repository', {}).get('name', {}).get('from')
+            update_cached_repos(github_organization, [repo], [renamed_from] if renamed_from else [])
+        if verbose:
+            print("repository %s: %s" % (payload['action'], repo['full_name']))
+
+    elif event_type == 'check_suite':
+        # the next lookup will get the new state of the suite from GitHub
+        repo_name = payload['repository']['full_name']
+        head_sha = payload['check_suite']['head_sha']
+        with _store_lock:
+            db = github_store()
+            with db:
+                db.execute("DELETE FROM completed_checks WHERE repo = ? AND sha = ?", (repo_name, head_sha))
+        if verbose:
+            print("check_suite %s: %s (%s)" % (payload['action'], repo_name, head_sha[0:7]))
+
+    else:
+        return None
+
+    return github_organization
+
+
+def cached_response(url: str) -> Optional[dict]:
+    """
+    Returns the cached response entry for a URL, or None if we've never seen it. The entry is a dict with
+    'url', 'etag', 'last_modified', 'link', and 'body' (the raw JSON text) fields.
+    """
+    with _store_lock:
+        row = github_store().execute("SELECT etag, last_modified, link, body FROM responses WHERE url = ?",
+                                     (url,)).fetchone()
+    if row is None:
+        return None
+
+    return {'url': url, 'etag': row[0], 'last_modified': row[1], 'link': row[2], 'body': row[3]}
+
+
+# The parsed JSON for responses we've handled in this run, along with their validators, so when GitHub says
+# one hasn't changed (e.g., while revalidating a long paged listing), we don't parse the same JSON again.
+_parsed_bodies = {}
+
+
+def cached_response_body(entry: dict):
+    """
+    Given an entry from cached_response, returns its body as parsed JSON.
+    """
+    validators = (entry['etag'], entry['last_modified'])
+    with _state_lock:
+        parsed = _parsed_bodies.get(entry['url'])
+    if parsed is None or parsed[0] != validators:
+        parsed = (validators, json.loads(entry['body']))
+        with _state_lock:
+            _parsed_bodies[entry['url']] = parsed
+    return parsed[1]
+
+
+def store_response(url: str, headers, body: bytes):
+    """
+    Remembers a successful response, assuming GitHub gave us a validator we can use to revalidate it later.
+    """
+    etag = headers.get('ETag', '')
+    last_modified = headers.get('Last-Modified', '')
+    if not etag and not last_modified:
+        return
+
+    with _state_lock:
+        _parsed_bodies.pop(url, None)
+    with _store_lock:
+        db = github_store()
+        with db:
+            db.execute("INSERT OR REPLACE INTO responses (url, etag, last_modified, link, body) "
+                       "VALUES (?, ?, ?, ?, ?)",
+                       (url, etag, last_modified, headers.get('Link', ''), body.decode('utf-8')))
+
+
+def conditional_headers(url: str) -> dict:
+    """
+    Returns the If-None-Match / If-Modified-Since headers to revalidate whatever we have cached for this URL.
+    """
+    entry = cached_response(url)
+    if entry is None:
+        return {}
+
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
 
 
 def github_headers(github_token: str) -> dict:
@@ -85,53 +493,1132 @@ def github_headers(github_token: str) -> dict:
     }
 
 
-def fail_on_github_errors(response: Response):
-    if response.status_code != 200:
-        print("\nRequest failed, status code: %d" % response.status_code)
-        print("Headers: %s\n" % dict_to_pretty_json(dict(response.headers)))
-        print("Body: %s\n" % dict_to_pretty_json(response.json()))
-        exit(1)
+def _printable_body(body: bytes) -> str:
+    # error pages from GitHub's load balancers are HTML, not JSON
+    try:
+        return dict_to_pretty_json(json.loads(body))
+    except ValueError:
+        return body.decode('utf-8', 'replace')
 
 
-async def fail_on_github_errors_async(response: ClientResponse):
+def fail_on_github_errors(response: GitHubResponse):
     if response.status != 200:
         print("\nRequest failed, status code: %d" % response.status)
         print("Headers: %s\n" % dict_to_pretty_json(dict(response.headers)))
-        print("Body: %s\n" % dict_to_pretty_json(await response.json()))
+        print("Body: %s\n" % _printable_body(response.body))
         exit(1)
 
 
-def fetch_team_infos(repo_info_list: List[dict], github_token: str, verbose: bool = True) -> dict:
+def _retry_reason(status: int, headers, body: bytes) -> str:
+    """
+    Decides whether a failed response is worth retrying, returning a short human-readable reason if so,
+    or an empty string if the failure is permanent (or if it wasn't a failure at all).
+    """
+    if status in RETRY_STATUS_CODES:
+        return "status %d" % status
+    elif status == 403:
+        # A 403 is usually a permissions problem, which retrying won't fix, except when it's GitHub
+        # telling us to slow down. The rate-limit scheduler has already noted when we may try again.
+        if headers.get('X-RateLimit-Remaining') == '0':
+            return "rate limit exhausted"
+        elif 'Retry-After' in headers or b'secondary rate limit' in body.lower():
+            return "secondary rate limit"
+    return ""
+
+
+def _retry_delay(attempt: int) -> float:
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def _report_retry(url: str, reason: str, attempt: int, delay: float, verbose: bool):
     if verbose:
-        print("Fetching team_urls...")
+        print("\nRequest for %s failed (%s), retry %d of %d in %.1f seconds"
+              % (url, reason, attempt, RETRY_MAX_ATTEMPTS - 1, delay))
+
+
+def _rate_limit_resource(url: str) -> str:
+    """
+    Guesses which of GitHub's rate-limit buckets a request URL will be charged against.
+    """
+    if '/graphql' in url:
+        return 'graphql'
+    elif '/search/' in url:
+        return 'search'
+    else:
+        return 'core'
+
+
+def _rate_limit_entry(resource: str) -> dict:
+    if resource not in rate_limit_state:
+        rate_limit_state[resource] = {'limit': None, 'remaining': None, 'reset': 0.0,
+                                      'blocked_until': 0.0, 'next_slot': 0.0, 'in_flight': 0}
+    return rate_limit_state[resource]
+
+
+def note_rate_limit_headers(url: str, headers) -> None:
+    """
+    Updates our view of the rate-limit budget from the headers of a response to the given URL.
+    """
+    with _state_lock:
+        entry = _rate_limit_entry(headers.get('X-RateLimit-Resource', _rate_limit_resource(url)))
+        now = time.time()
+
+        if 'X-RateLimit-Remaining' in headers and 'X-RateLimit-Reset' in headers:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = float(headers['X-RateLimit-Reset'])
+            if 'X-RateLimit-Limit' in headers:
+                entry['limit'] = int(headers['X-RateLimit-Limit'])
+
+            # GitHub's count is the truth, and it can go up as well as down: a "304 Not Modified" is free,
+            # so a request we were worried about may not have cost anything. Requests still in flight are
+            # accounted for separately (see _rate_limit_delay), so we don't need to guess about them here.
+            entry['remaining'] = remaining
+            entry['reset'] = reset
+
+        if 'Retry-After' in headers:
+            try:
+                entry['blocked_until'] = max(entry['blocked_until'], now + float(headers['Retry-After']))
+            except ValueError:
+                pass  # GitHub only sends a number of seconds, but the spec also allows an HTTP date
+
+
+def note_poll_interval(url: str, headers) -> None:
+    if 'X-Poll-Interval' in headers:
+        try:
+            with _state_lock:
+                poll_intervals[url] = int(headers['X-Poll-Interval'])
+        except ValueError:
+            pass
+
+
+def poll_interval(default: float, url: str = None) -> float:
+    """
+    Returns how many seconds to wait before polling again: the given default, unless GitHub has asked
+    us to wait longer, either for the given URL, or if it's None, for anything we've asked about.
+    """
+    with _state_lock:
+        if url is not None:
+            return max(default, poll_intervals.get(url, 0))
+        return max([default] + list(poll_intervals.values()))
+
+
+def _rate_limit_delay(url: str) -> float:
+    """
+    Reserves a dispatch slot for a request to the given URL, returning how many seconds the caller
+    should sleep before sending it. The request counts as in flight, and against what's left of the
+    budget, until _rate_limit_request_done says it's finished, so concurrent callers get spaced out
+    rather than all waking up together.
+    """
+    with _state_lock:
+        entry = _rate_limit_entry(_rate_limit_resource(url))
+        now = time.time()
+        limit = entry['limit']
+
+        if entry['reset'] <= now and entry['remaining'] is not None:
+            # the window has rolled over; we'll learn the new budget from the next response
+            entry['remaining'] = None
+            entry['next_slot'] = 0.0
+
+        remaining = entry['remaining'] - entry['in_flight'] if entry['remaining'] is not None else None
+
+        if remaining is None:
+            spacing = 0.0
+            start = now
+        elif remaining <= 0:
+            # out of budget: nothing goes out until the window resets
+            spacing = 0.0
+            start = entry['reset'] + 1.0
+        elif limit is not None and remaining < limit * RATE_LIMIT_LOW_WATER_FRACTION:
+            spacing = (entry['reset'] - now) / remaining
+            start = now
+        else:
+            spacing = 0.0
+            start = now
+
+        slot = max(start, entry['blocked_until'], entry['next_slot'] if spacing > 0 else 0.0)
+        entry['next_slot'] = slot + spacing
+        entry['in_flight'] = entry['in_flight'] + 1
+
+        return max(0.0, slot - now)
+
+
+def _rate_limit_request_done(url: str):
+    """
+    Notes that a request reserved with _rate_limit_delay has finished (or failed), after which only
+    GitHub's own count of the remaining budget says what it cost.
+    """
+    with _state_lock:
+        entry = _rate_limit_entry(_rate_limit_resource(url))
+        entry['in_flight'] = max(0, entry['in_flight'] - 1)
+
+
+def _report_rate_limit_wait(delay: float, verbose: bool):
+    if verbose and delay >= 5:
+        print("GitHub API budget is low, waiting %d seconds (until %s)"
+              % (delay, localtime_from_timestamp(time.time() + delay)))
+
+
+async def wait_for_rate_limit_async(url: str, verbose: bool = True):
+    """
+    Sleeps until the rate-limit scheduler says it's okay to send a request to the given URL.
+    """
+    delay = _rate_limit_delay(url)
+    if delay > 0:
+        _report_rate_limit_wait(delay, verbose)
+        await asyncio.sleep(delay)
+
+
+def scanner_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the event loop we use to run our async code on behalf of synchronous callers.
+    """
+    global _client_loop
+
+    if _client_loop is None or _client_loop.is_closed():
+        _client_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_client_loop)
+    return _client_loop
+
+
+def _event_loop_is_running() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def _fail_if_event_loop_running(coroutine=None):
+    if _event_loop_is_running():
+        if coroutine is not None:
+            coroutine.close()  # otherwise Python warns that it was never awaited
+        raise RuntimeError("github_scanner's synchronous functions can't be called while an event loop is running "
+                           "(e.g., in a Jupyter notebook or an aiohttp server); await the _async version instead")
+
+
+def run_scanner_coroutine(coroutine):
+    """
+    Runs a coroutine to completion on the scanner's event loop, for use from synchronous code. Every
+    synchronous function here that talks to GitHub works this way, so none of them can be called from
+    code that's already running in an event loop. Such code should await the _async versions instead.
+    """
+    _fail_if_event_loop_running(coroutine)
+    return scanner_event_loop().run_until_complete(coroutine)
+
+
+def iterate_on_scanner_loop(async_iterator):
+    """
+    Runs an async generator on the scanner's event loop, for use from synchronous code, yielding each
+    item as soon as it's available. The same restriction applies as for run_scanner_coroutine.
+    """
+    _fail_if_event_loop_running()
+    loop = scanner_event_loop()
+    try:
+        while True:
+            try:
+                item = loop.run_until_complete(async_iterator.__anext__())
+            except StopAsyncIteration:
+                break
+            yield item
+    finally:
+        loop.run_until_complete(async_iterator.aclose())
+
+
+def scanner_session() -> ClientSession:
+    """
+    Returns the shared aiohttp session for the currently running event loop, creating it on first use.
+    """
+    loop = asyncio.get_running_loop()
+    session = _client_sessions.get(loop)
+    if session is None or session.closed:
+        session = ClientSession(connector=TCPConnector(limit=CONNECTION_POOL_SIZE,
+                                                       limit_per_host=CONNECTION_POOL_SIZE))
+        _client_sessions[loop] = session
+    return session
+
+
+def close_scanner_sessions():
+    """
+    Closes the shared sessions, along with their pooled connections. This happens automatically when
+    the program exits.
+    """
+    for loop, session in list(_client_sessions.items()):
+        if not session.closed and not loop.is_closed() and not loop.is_running():
+            loop.run_until_complete(session.close())
+    _client_sessions.clear()
+
+
+async def close_scanner_session_async():
+    """
+    Closes the shared session for the currently running event loop. If you're using the async API from
+    your own event loop, await this before shutting that loop down.
+    """
+    session = _client_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+atexit.register(close_scanner_sessions)
+
+
+async def _github_request_async(method: str, url: str, github_token: str, verbose: bool = True,
+                                extra_headers: dict = None, data: str = None,
+                                semaphore: asyncio.Semaphore = None) -> GitHubResponse:
+    """
+    All of our traffic to GitHub goes through here, so it's subject to the rate-limit scheduler and
+    transient failures are retried. If we run out of retries, the last response is returned, and the
+    caller's usual error handling takes over. If a semaphore is given, the request (including any
+    retries) counts against it.
+    """
+    if semaphore is not None:
+        async with semaphore:
+            return await _github_request_async(method, url, github_token, verbose, extra_headers, data)
+
+    headers = github_headers(github_token)
+    if extra_headers:
+        headers.update(extra_headers)
+
+    session = scanner_session()
+    attempt = 1
+    while True:
+        try:
+            # once this has reserved our place, the finally clause below gives it back, whatever happens
+            await wait_for_rate_limit_async(url, verbose)
+            async with session.request(method, url, headers=headers, data=data) as response:
+                note_rate_limit_headers(url, response.headers)
+                note_poll_interval(url, response.headers)
+                result = GitHubResponse(response.status, response.headers, await response.read())
+                reason = _retry_reason(result.status, result.headers, result.body)
+                if not reason or attempt == RETRY_MAX_ATTEMPTS:
+                    return result
+        except (ClientError, asyncio.TimeoutError) as e:
+            if attempt == RETRY_MAX_ATTEMPTS:
+                raise
+            reason = type(e).__name__
+        finally:
+            _rate_limit_request_done(url)
+
+        delay = _retry_delay(attempt)
+        _report_retry(url, reason, attempt, delay, verbose)
+        await asyncio.sleep(delay)
+        attempt = attempt + 1
+
+
+# Within a run, we often want the same URL more than once, e.g., when several repos share a team, they all
+# lead us to the same members_url. Identical GETs that are in flight at the same time share one request,
+# and once we have an answer, we remember it for the rest of the run, so each distinct URL costs us
+# at most one request per run.
+_memoized_gets = {}
+_in_flight_gets = {}
+
+
+def forget_memoized_responses():
+    """
+    Forgets the GET responses we've remembered during this run, so the next request for each URL goes
+    back to GitHub (which is still only a 304 if nothing has changed). Anything that runs for a long time
+    and wants to notice changes, rather than just doing one scan, should call this between passes.
+    """
+    with _state_lock:
+        _memoized_gets.clear()
+
+
+def _forget_memoized_urls(url_prefix: str):
+    with _state_lock:
+        for memo_key in [memo_key for memo_key in _memoized_gets.keys() if memo_key[0].startswith(url_prefix)]:
+            del _memoized_gets[memo_key]
+
+
+async def _github_get_revalidated_async(url: str, github_token: str, verbose: bool,
+                                        semaphore: Optional[asyncio.Semaphore], missing_ok: bool) -> dict:
+    result = await _github_request_async('GET', url, github_token, verbose,
+                                         extra_headers=conditional_headers(url), semaphore=semaphore)
+
+    if result.status == 304:
+        entry = cached_response(url)
+        response = {'url': url, 'body': cached_response_body(entry), 'link': entry['link'], 'revalidated': True}
+    elif missing_ok and result.status in [404, 409]:
+        response = {'url': url, 'body': None, 'link': '', 'revalidated': False, 'status': result.status}
+    else:
+        fail_on_github_errors(result)
+        store_response(url, result.headers, result.body)
+        response = {'url': url, 'body': json.loads(result.body), 'link': result.headers.get('Link', ''),
+                    'revalidated': False}
+
+    with _state_lock:
+        _memoized_gets[(url, github_token, missing_ok)] = response
+    return response
+
+
+async def _github_get_cached_async(url: str, github_token: str, verbose: bool = True,
+                                   semaphore: asyncio.Semaphore = None, missing_ok: bool = False) -> dict:
+    """
+    GET through the response cache. Returns a dict with 'url', 'body' (the parsed JSON), 'link' (the
+    pagination header, if any), and 'revalidated' (True if GitHub said our copy was current). If missing_ok
+    is True, a 404 (not found) or 409 (an empty repo) isn't an error, and just results in a body of None,
+    along with the 'status', so the caller can tell which it was.
+    """
+    memo_key = (url, github_token, missing_ok)
+    with _state_lock:
+        memoized = _memoized_gets.get(memo_key)
+    if memoized is not None:
+        return dict(memoized)
+
+    # tasks belong to an event loop, so callers on different loops can't share them
+    in_flight_key = (asyncio.get_running_loop(),) + memo_key
+    task = _in_flight_gets.get(in_flight_key)
+    if task is None:
+        task = asyncio.ensure_future(_github_get_revalidated_async(url, github_token, verbose, semaphore,
+                                                                   missing_ok))
+        _in_flight_gets[in_flight_key] = task
+        task.add_done_callback(lambda _: _in_flight_gets.pop(in_flight_key, None))
+
+    # shielded, so if one of the callers waiting on this request is cancelled, the others still get an answer
+    return dict(await asyncio.shield(task))
+
+
+# GitHub returns 30 items per page of a listing unless we ask for more, and 100 is the most it allows.
+MAX_PAGE_SIZE = 100
+
+
+def _paged_url(endpoint: str, page_number: int = 1) -> str:
+    """
+    Given the URL for a listing, returns the URL for the requested page of it, with as many items per
+    page as GitHub allows. Any other query parameters on the URL are preserved.
+    """
+    parts = urllib.parse.urlsplit(endpoint)
+    query = [(k, v) for (k, v) in urllib.parse.parse_qsl(parts.query) if k not in ['page', 'per_page']]
+    query.append(('per_page', str(MAX_PAGE_SIZE)))
+    if page_number > 1:
+        query.append(('page', str(page_number)))
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+def parse_link_header(link_header: str) -> dict:
+    """
+    Parses GitHub's Link header, e.g., '<https://...&page=2>; rel="next", <https://...&page=5>; rel="last"',
+    into a dict from each "rel" to its URL.
+    """
+    return {rel: url for (url, rel) in re.findall('<([^>]*)>;\\s*rel="([^"]*)"', link_header)}
+
+
+def _last_page_number(link_header: str) -> int:
+    """
+    Returns the number of pages in a listing, given the Link header from its first page, or 0 if the
+    listing is paged with opaque cursors rather than page numbers, so we can only follow the "next" links.
+    """
+    links = parse_link_header(link_header)
+    if 'last' in links:
+        pages = urllib.parse.parse_qs(urllib.parse.urlsplit(links['last']).query).get('page', [])
+        return int(pages[0]) if pages else 0
+    elif 'next' in links:
+        return 0
+    else:
+        return 1
+
+
+def _cached_page_count(endpoint: str) -> int:
+    """
+    Returns how many pages the given listing had the last time we fetched it, or 0 if we don't know.
+    """
+    entry = cached_response(_paged_url(endpoint))
+    if entry is None:
+        return 0
+    return _last_page_number(entry['link'])
+
+
+async def _iter_pages_async(endpoint: str, github_token: str, semaphore: asyncio.Semaphore, verbose: bool = True):
+    """
+    Async generator that yields (page_number, result) for every page of a listing as soon as that page
+    arrives, which isn't necessarily in order. The result is the same dict that _fetch returns.
+
+    If GitHub tells us how many pages there are (a rel="last" link), every page is fetched in parallel.
+    If we've seen this listing before, we already know how many pages it had, and we have each page and
+    its ETag in the response cache, so we revalidate all of them at once, without waiting on page 1.
+    Pages that haven't changed come back as (free) 304s, and only pages that did change are downloaded
+    and parsed. If the listing uses cursors instead (only a rel="next" link), we have no choice but to
+    follow the links one at a time.
+    """
+    if not endpoint.startswith('https:'):
+        endpoint = 'https://api.github.com/' + endpoint
+
+    def launch(n: int) -> asyncio.Future:
+        url = _paged_url(endpoint, n)
+        return asyncio.ensure_future(_fetch(n, url, github_token, semaphore, verbose))
+
+    known_pages = max(1, _cached_page_count(endpoint))
+    tasks = {n: launch(n) for n in range(1, known_pages + 1)}
+    try:
+        # page 1 tells us how many pages there are now, which may differ from last time
+        page1_result = await tasks.pop(1)
+        num_pages = _last_page_number(page1_result['link'])
+        for n in range(known_pages + 1, num_pages + 1):
+            tasks[n] = launch(n)
+        for n in [n for n in tasks.keys() if n > max(num_pages, 1)]:
+            tasks.pop(n).cancel()
+
+        yield 1, page1_result
+        for future in asyncio.as_completed(list(tasks.values())):
+            result = await future
+            yield result['key'], result
+
+        if num_pages == 0:
+            result = page1_result
+            page_number = 1
+            while 'next' in parse_link_header(result['link']):
+                page_number = page_number + 1
+                result = await _fetch(page_number, parse_link_header(result['link'])['next'], github_token,
+                                      semaphore, verbose)
+                yield page_number, result
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+
+async def _get_all_pages_async(key, endpoint: str, github_token: str, semaphore: asyncio.Semaphore,
+                               verbose: bool = True) -> dict:
+    """
+    Fetches every page of a listing, returning a dict like _fetch does, except the 'body' is the whole
+    listing, in order, and there are two more fields: 'num_pages' and 'num_revalidated', the number of
+    pages that GitHub said were unchanged since last time.
+    """
+    pages = {}
+    async for page_number, result in _iter_pages_async(endpoint, github_token, semaphore, verbose):
+        pages[page_number] = result
+
+    return {'key': key,
+            'url': endpoint,
+            'body': [item for n in sorted(pages.keys()) for item in pages[n]['body']],
+            'num_pages': len(pages),
+            'num_revalidated': len([n for n in pages.keys() if pages[n]['revalidated']])}
+
+
+# Multi-stage fetches, like finding each repo's refs and then the check suites for its head commit, run as
+# a pipeline: each item moves on to its next stage as soon as its previous stage is done, rather than
+# waiting for every item to finish a stage before any of them can start the next one. Each stage has its
+# own limit on how many of its requests can be in flight at once, so one slow request only holds up its
+# own item, and a big backlog in one stage can't starve the stages after it.
+PipelineStage = namedtuple('PipelineStage', ['function', 'max_in_flight'])
+
+
+def github_get_stage(url_function, github_token: str, verbose: bool = True,
+                     max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, paged: bool = False,
+                     missing_ok: bool = False) -> PipelineStage:
+    """
+    Makes a pipeline stage that fetches the endpoint returned by url_function(key, value), where the value
+    is whatever the previous stage produced for that key (or the initial value, for the first stage). The
+    stage produces the same dict that parallel_get_github_endpoint would, with 'key', 'url', and 'body'.
+    If paged is True, the endpoint is a listing, all of whose pages are fetched. If url_function returns
+    None, or if missing_ok is True and GitHub says the endpoint doesn't exist, the item is dropped.
+    """
+    async def fetch_stage(key, value, semaphore: asyncio.Semaphore) -> Optional[dict]:
+        url = url_function(key, value)
+        if url is None:
+            return None
+        if not url.startswith('https:'):
+            url = 'https://api.github.com/' + url
+
+        if paged:
+            return await _get_all_pages_async(key, url, github_token, semaphore, verbose)
+
+        result = await _github_get_cached_async(url, github_token, verbose, semaphore, missing_ok)
+        if result['body'] is None:
+            return None
+        result['key'] = key
+        return result
+
+    return PipelineStage(fetch_stage, max_in_flight)
+
+
+async def iter_pipeline_async(items: dict, stages: List[PipelineStage]):
+    """
+    Async generator that runs every item through the stages of a pipeline, yielding (key, value) for
+    each item as soon as it's made it through the last stage, in no particular order. The items are a
+    dict from each key to its initial value. Each stage's function is a coroutine function taking a key,
+    the previous stage's value for it, and the stage's semaphore (to be passed along to any requests it
+    makes), and returning the next value, or None to drop the item.
+    """
+    semaphores = [asyncio.Semaphore(stage.max_in_flight) for stage in stages]
+
+    async def run_item(key, value):
+        for stage, semaphore in zip(stages, semaphores):
+            value = await stage.function(key, value, semaphore)
+            if value is None:
+                break
+        return key, value
+
+    tasks = [asyncio.ensure_future(run_item(key, value)) for (key, value) in items.items()]
+    try:
+        for future in asyncio.as_completed(tasks):
+            key, value = await future
+            if value is not None:
+                yield key, value
+    finally:
+        for task in tasks:
+            task.cancel()
 
-    team_url_results = parallel_get_github_endpoint(
-        [{'key': repo['html_url'], 'url': repo['teams_url']}
-         for repo in repo_info_list],
-        github_token)
+
+async def run_pipeline_async(items: dict, stages: List[PipelineStage]) -> dict:
+    """
+    Runs every item through the stages of a pipeline (see iter_pipeline_async), returning a dict from
+    each key to its value from the last stage. Items dropped along the way are left out.
+    """
+    return {key: value async for (key, value) in iter_pipeline_async(items, stages)}
+
+
+def run_pipeline(items: dict, stages: List[PipelineStage]) -> dict:
+    return run_scanner_coroutine(run_pipeline_async(items, stages))
+
+
+def iter_pipeline(items: dict, stages: List[PipelineStage]):
+    return iterate_on_scanner_loop(iter_pipeline_async(items, stages))
+
+
+# Optional GraphQL backend. As described in refresh_repo_listing, we've seen GitHub's v4 GraphQL API
+# sometimes leave things out of its results, so we never trust it blindly: everything we get back is
+# checked against the repo listing we got from the REST API, and anything missing or inconsistent is
+# fetched again with REST. When it works, one GraphQL query replaces a few hundred REST requests.
+GRAPHQL_URL = 'https://api.github.com/graphql'
+GRAPHQL_BATCH_SIZE = 100
+GRAPHQL_MAX_IN_FLIGHT = 4
+
+_graphql_repo_head_fragment = """
+fragment RepoHead on Repository {
+  databaseId
+  nameWithOwner
+  defaultBranchRef {
+    name
+    target {
+      ... on Commit {
+        oid
+        checkSuites(first: 100) {
+          totalCount
+          nodes { databaseId conclusion status createdAt }
+        }
+      }
+    }
+  }
+}
+"""
+
+_graphql_team_query = """
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    teams(first: 100, after: $cursor) {
+      totalCount
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        members(first: 100) { totalCount nodes { login } }
+        repositories(first: 100) { totalCount nodes { databaseId } }
+      }
+    }
+  }
+}
+"""
+
+
+async def graphql_query_async(query: str, variables: dict, github_token: str, verbose: bool = True,
+                              semaphore: asyncio.Semaphore = None) -> dict:
+    """
+    Runs a GraphQL query and returns its 'data'. GraphQL reports many problems, such as a repo that
+    doesn't exist, as 'errors' alongside partial data, so those are printed (if verbose) but not fatal.
+    """
+    result = await _github_request_async('POST', GRAPHQL_URL, github_token, verbose,
+                                         data=json.dumps({'query': query, 'variables': variables}),
+                                         semaphore=semaphore)
+    fail_on_github_errors(result)
+    body = json.loads(result.body)
+
+    if verbose and body.get('errors'):
+        print("GraphQL query returned %d errors, first one: %s" % (len(body['errors']),
+                                                                   body['errors'][0].get('message')))
+    return body.get('data') or {}
+
+
+def graphql_query(query: str, variables: dict, github_token: str, verbose: bool = True) -> dict:
+    return run_scanner_coroutine(graphql_query_async(query, variables, github_token, verbose))
+
+
+def _repo_head_from_graphql(node: dict) -> Optional[dict]:
+    ref = node['defaultBranchRef']
+    if ref is None or ref['target'] is None:
+        # an empty repo, with no commits at all
+        return {'default_branch': None, 'head_sha': None, 'check_suite': None}
+
+    head_sha = ref['target']['oid']
+    suites = ref['target']['checkSuites']
+    if len(suites['nodes']) < suites['totalCount']:
+        # we can't tell which suite first_check_suite would pick, so REST will have to answer for this one
+        return None
+
+    # same fields, and same lower-case values, as the REST API
+    check_suite = first_check_suite([{'id': suite['databaseId'],
+                                      'conclusion': suite['conclusion'].lower() if suite['conclusion'] else None,
+                                      'status': suite['status'].lower(),
+                                      'created_at': suite['createdAt'],
+                                      'head_sha': head_sha}
+                                     for suite in suites['nodes']])
+    return {'default_branch': ref['name'], 'head_sha': head_sha, 'check_suite': check_suite}
+
+
+async def _graphql_repo_heads_batch_async(repo_batch: List[dict], github_token: str, semaphore: asyncio.Semaphore,
+                                          verbose: bool = True) -> dict:
+    params = ", ".join("$o%d: String!, $n%d: String!" % (i, i) for i in range(len(repo_batch)))
+    fields = "\n".join("  r%d: repository(owner: $o%d, name: $n%d) { ...RepoHead }" % (i, i, i)
+                       for i in range(len(repo_batch)))
+    query = "query(%s) {\n%s\n}\n%s" % (params, fields, _graphql_repo_head_fragment)
+
+    variables = {}
+    for i, repo in enumerate(repo_batch):
+        variables['o%d' % i], variables['n%d' % i] = repo['full_name'].split('/', 1)
+
+    data = await graphql_query_async(query, variables, github_token, verbose, semaphore)
+
+    results = {}
+    for i, repo in enumerate(repo_batch):
+        node = data.get('r%d' % i)
+        # only trust answers about the repo we actually asked about
+        if node is not None and node['databaseId'] == repo['id']:
+            head = _repo_head_from_graphql(node)
+            if head is not None:
+                results[repo['full_name']] = head
+    return results
+
+
+async def graphql_repo_heads_async(repo_info_list: List[dict], github_token: str, verbose: bool = True) -> dict:
+    """
+    Uses GraphQL to find the default branch, its head commit SHA, and the first check suite on that commit
+    (see first_check_suite) for every repo in the list (the dicts from query_matching_repos), a hundred
+    repos per query. Returns a dict from each repo's full_name to a dict with 'default_branch', 'head_sha',
+    and 'check_suite' fields. Repos that GraphQL didn't answer for, or answered for inconsistently, are
+    left out.
+    """
+    semaphore = asyncio.Semaphore(GRAPHQL_MAX_IN_FLIGHT)
+    batches = [repo_info_list[i:i + GRAPHQL_BATCH_SIZE] for i in range(0, len(repo_info_list), GRAPHQL_BATCH_SIZE)]
+    batch_results = await asyncio.gather(*[_graphql_repo_heads_batch_async(batch, github_token, semaphore, verbose)
+                                           for batch in batches])
+
+    results = {}
+    for batch_result in batch_results:
+        results.update(batch_result)
+    return results
+
+
+async def graphql_team_members_async(github_organization: str, github_token: str,
+                                     verbose: bool = True) -> Optional[dict]:
+    """
+    Uses GraphQL to list every team in the organization, along with its members and its repos. Returns
+    a dict from each repo's id (the REST 'id', or the GraphQL 'databaseId') to the logins of the members
+    of its team (if a repo has several teams, we take the first, like fetch_team_infos). If the results
+    don't add up, e.g., fewer teams than GitHub says there are, or a team with more members or repos
+    than fit in one query, this returns None, and the caller should use REST instead.
+    """
+    results = {}
+    cursor = None
+    num_teams = 0
+    while True:
+        data = await graphql_query_async(_graphql_team_query, {'org': github_organization, 'cursor': cursor},
+                                         github_token, verbose)
+        if not data.get('organization'):
+            return None
+
+        teams = data['organization']['teams']
+        for team in teams['nodes']:
+            if team is None or team['members']['totalCount'] != len(team['members']['nodes']) \
+                    or team['repositories']['totalCount'] != len(team['repositories']['nodes']):
+                return None
+            num_teams = num_teams + 1
+            logins = [member['login'] for member in team['members']['nodes']]
+            for repo in team['repositories']['nodes']:
+                results.setdefault(repo['databaseId'], logins)
+
+        if not teams['pageInfo']['hasNextPage']:
+            break
+        cursor = teams['pageInfo']['endCursor']
+
+    if num_teams != teams['totalCount']:
+        return None
+
+    return results
+
+
+async def resolve_repo_head_async(repo: dict, github_token: str, verbose: bool = True,
+                                  semaphore: asyncio.Semaphore = None) -> dict:
+    """
+    Finds the head commit of a repo's default branch (e.g., 'main' or 'master', as given by the repo's
+    'default_branch' in the dicts from query_matching_repos), asking GitHub for just that one ref, rather
+    than listing all of the refs. Returns a dict with 'default_branch' and 'head_sha', both of which are
+    None for an empty repo. The answer is cached until somebody next pushes to the repo.
+    """
+    async def get_ref(branch: str) -> dict:
+        return await _github_get_cached_async('https://api.github.com/repos/%s/git/ref/heads/%s'
+                                              % (repo['full_name'], urllib.parse.quote(branch)),
+                                              github_token, verbose, semaphore, missing_ok=True)
+
+    branch = repo.get('default_branch') or 'master'
+    head = load_derived(repo, 'head')
+    if head is not None and head['default_branch'] not in [None, branch]:
+        head = None  # the default branch has changed (e.g., from master to main) since we looked
+
+    if head is None:
+        ref_result = await get_ref(branch)
+        if ref_result['body'] is None and ref_result['status'] == 404:
+            # Either the default_branch we have is out of date, which renaming a branch can do without a push,
+            # or we can't see the repo at all. Asking about the repo itself tells us which (or fails, if we
+            # can't see it).
+            repo_body = (await _github_get_cached_async('https://api.github.com/repos/' + repo['full_name'],
+                                                        github_token, verbose, semaphore))['body']
+            if repo_body.get('default_branch') and repo_body['default_branch'] != branch:
+                branch = repo_body['default_branch']
+                ref_result = await get_ref(branch)
+
+        if ref_result['body'] is not None:
+            head = {'default_branch': branch, 'head_sha': ref_result['body']['object']['sha']}
+        elif ref_result['status'] == 409:
+            # "Git Repository is empty"
+            head = {'default_branch': None, 'head_sha': None}
+        else:
+            print("\nCan't find branch %s of %s (status code: %d)" % (branch, repo['full_name'],
+                                                                      ref_result['status']))
+            exit(1)
+        store_derived(repo, 'head', head)
+    return head
+
+
+async def resolve_repo_heads_async(repo_info_list: List[dict], github_token: str, verbose: bool = True,
+                                   max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> dict:
+    """
+    Runs resolve_repo_head_async for every repo in the list, in parallel, returning a dict from each repo's
+    full_name to its result.
+    """
+    semaphore = asyncio.Semaphore(max_in_flight)
+    heads = await asyncio.gather(*[resolve_repo_head_async(repo, github_token, verbose, semaphore)
+                                   for repo in repo_info_list])
+    return {repo['full_name']: head for (repo, head) in zip(repo_info_list, heads)}
+
+
+def resolve_repo_heads(repo_info_list: List[dict], github_token: str, verbose: bool = True,
+                       max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> dict:
+    return run_scanner_coroutine(resolve_repo_heads_async(repo_info_list, github_token, verbose, max_in_flight))
+
+
+async def _fetch_checks_async(repo_name: str, sha: str, kind: str, github_token: str, verbose: bool,
+                              semaphore: Optional[asyncio.Semaphore]) -> dict:
+    checks = load_completed_checks(repo_name, sha, kind)
+    if checks is not None:
+        return checks
+
+    checks = (await _github_get_cached_async('https://api.github.com/repos/%s/commits/%s/%s' % (repo_name, sha, kind),
+                                             github_token, verbose, semaphore))['body']
+
+    # e.g., 'check-suites' -> the 'check_suites' field; while any of them is still pending (or before the first
+    # one shows up), we'll have to ask again next time
+    items = checks.get(kind.replace('-', '_'), [])
+    if items and all(item.get('status') == 'completed' and item.get('conclusion') is not None for item in items):
+        store_completed_checks(repo_name, sha, kind, checks)
+    return checks
+
+
+async def fetch_check_suites_async(repo_name: str, sha: str, github_token: str, verbose: bool = True,
+                                   semaphore: asyncio.Semaphore = None) -> dict:
+    """
+    Returns GitHub's check-suites response (a dict with a 'check_suites' list) for a commit in the given
+    repo (its full_name). Once every suite on a commit has a conclusion, the response is kept forever, and
+    we never ask GitHub about that commit again.
+    """
+    return await _fetch_checks_async(repo_name, sha, 'check-suites', github_token, verbose, semaphore)
+
+
+def fetch_check_suites(repo_name: str, sha: str, github_token: str, verbose: bool = True) -> dict:
+    return run_scanner_coroutine(fetch_check_suites_async(repo_name, sha, github_token, verbose))
+
+
+async def fetch_check_runs_async(repo_name: str, sha: str, github_token: str, verbose: bool = True,
+                                 semaphore: asyncio.Semaphore = None) -> dict:
+    """
+    Like fetch_check_suites_async, but for the individual check runs (a dict with a 'check_runs' list).
+    """
+    return await _fetch_checks_async(repo_name, sha, 'check-runs', github_token, verbose, semaphore)
+
+
+def fetch_check_runs(repo_name: str, sha: str, github_token: str, verbose: bool = True) -> dict:
+    return run_scanner_coroutine(fetch_check_runs_async(repo_name, sha, github_token, verbose))
+
+
+def first_check_suite(check_suites: List[dict]) -> Optional[dict]:
+    """
+    Of the check suites on a commit (as in the 'check_suites' list of a check-suites response), returns the
+    one GitHub created first, or None if there aren't any. Neither the REST nor the GraphQL API promises
+    to list them in any particular order, so we go by id, so that both give the same answer.
+    """
+    return min(check_suites, key=lambda suite: suite['id'], default=None)
+
+
+async def iter_repo_heads_async(repo_info_list: List[dict], github_token: str, verbose: bool = True,
+                                max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+    """
+    Async generator version of fetch_repo_heads (using only the REST API), yielding (full_name, result)
+    for each repo as soon as its answer is in, in no particular order.
+    """
+    async def head_stage(repo_name: str, repo: dict, semaphore: asyncio.Semaphore) -> dict:
+        return await resolve_repo_head_async(repo, github_token, verbose, semaphore)
+
+    async def check_suite_stage(repo_name: str, head: dict, semaphore: asyncio.Semaphore) -> dict:
+        if head['head_sha'] is None:
+            return {'default_branch': None, 'head_sha': None, 'check_suite': None}
+
+        suites = (await fetch_check_suites_async(repo_name, head['head_sha'], github_token, verbose,
+                                                 semaphore)).get('check_suites', [])
+        return {'default_branch': head['default_branch'], 'head_sha': head['head_sha'],
+                'check_suite': first_check_suite(suites)}
+
+    async for repo_name, result in iter_pipeline_async({repo['full_name']: repo for repo in repo_info_list},
+                                                       [PipelineStage(head_stage, max_in_flight),
+                                                        PipelineStage(check_suite_stage, max_in_flight)]):
+        yield repo_name, result
+
+
+def iter_repo_heads(repo_info_list: List[dict], github_token: str, verbose: bool = True,
+                    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+    return iterate_on_scanner_loop(iter_repo_heads_async(repo_info_list, github_token, verbose, max_in_flight))
+
+
+async def fetch_repo_heads_async(repo_info_list: List[dict], github_token: str, verbose: bool = True,
+                                 use_graphql: bool = False, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> dict:
+    """
+    For every repo in the list (the dicts from query_matching_repos), finds the head commit of its default
+    branch and the first check suite run on that commit (see first_check_suite). Returns a dict from each
+    repo's full_name to a dict with 'default_branch', 'head_sha', and 'check_suite' (a dict like the REST
+    API's, with 'id', 'conclusion', 'status', 'created_at', and 'head_sha', or None if there's no check
+    suite). Empty repos have None for everything. If use_graphql is True, we try GraphQL first, falling
+    back to REST for whatever GraphQL didn't give us.
+    """
+    results = {}
+    if use_graphql:
+        results = await graphql_repo_heads_async(repo_info_list, github_token, verbose)
+        for repo in repo_info_list:
+            if repo['full_name'] in results:
+                store_derived(repo, 'head', {'default_branch': results[repo['full_name']]['default_branch'],
+                                             'head_sha': results[repo['full_name']]['head_sha']})
+
+    missing = [repo for repo in repo_info_list if repo['full_name'] not in results]
+    if verbose and use_graphql and missing:
+        print("%d of %d repos missing from GraphQL results, using REST for those"
+              % (len(missing), len(repo_info_list)))
+
+    async for repo_name, result in iter_repo_heads_async(missing, github_token, verbose, max_in_flight):
+        results[repo_name] = result
+    return results
+
+
+def fetch_repo_heads(repo_info_list: List[dict], github_token: str, verbose: bool = True,
+                     use_graphql: bool = False, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> dict:
+    return run_scanner_coroutine(fetch_repo_heads_async(repo_info_list, github_token, verbose, use_graphql,
+                                                        max_in_flight))
+
+
+def _team_info(repo: dict, logins: List[str]) -> dict:
+    return {'key': repo['html_url'],
+            'url': repo['teams_url'],
+            'body': [{'login': login} for login in logins],
+            'team_members': logins}
+
+
+async def fetch_team_infos_async(repo_info_list: List[dict], github_token: str, verbose: bool = True,
+                                 max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, use_graphql: bool = False) -> dict:
+    """
+    Finds the team attached to each repo in the list (the dicts from query_matching_repos), returning a
+    dict from each repo's html_url to a dict whose 'team_members' field is a list of the team members'
+    GitHub logins. Repos without a team are left out. If use_graphql is True, we first try to get every
+    team in the organization with a single GraphQL query, and only use the REST API if that doesn't work.
+    Students join and leave teams without pushing anything, so unlike a repo's head commit, we can't
+    remember its team until the next push. Instead, every listing is revalidated with its ETag, which is
+    free when nothing's changed.
+    """
+    if use_graphql and repo_info_list:
+        github_organization = repo_info_list[0]['full_name'].split('/')[0]
+        team_members = await graphql_team_members_async(github_organization, github_token, verbose)
+        if team_members is not None:
+            return {repo['html_url']: _team_info(repo, team_members[repo['id']])
+                    for repo in repo_info_list if team_members.get(repo['id'])}
+        elif verbose:
+            print("GraphQL team listing was incomplete, using REST instead")
 
     if verbose:
-        print("Fetching team_data...")
+        print("Fetching team_urls and team_data...")
+
+    def members_url(key, teams: dict) -> Optional[str]:
+        # we're assuming there's zero or one teams, and filtering out the zeroes
+        if not teams['body']:
+            return None
+        return re.sub('{/member}', '', teams['body'][0]['members_url'])
 
-    # we're assuming there's zero or one teams, and filtering out the zeroes
-    member_data_results = parallel_get_github_endpoint(
-        [{'key': k, 'url': re.sub('{/member}', '', team_url_results[k]['body'][0]['members_url'])}
-         for k in team_url_results.keys()
-         if team_url_results[k]['body']], github_token, verbose)
+    member_data_results = await run_pipeline_async(
+        {repo['html_url']: repo for repo in repo_info_list},
+        [github_get_stage(lambda key, repo: repo['teams_url'], github_token, verbose, max_in_flight, paged=True),
+         github_get_stage(members_url, github_token, verbose, max_in_flight, paged=True)])
 
-    for member in member_data_results.keys():
-        member_data_results[member]['team_members'] = [x['login'] for x in member_data_results[member]['body']]
+    for member_data in member_data_results.values():
+        member_data['team_members'] = [x['login'] for x in member_data['body']]
 
     return member_data_results
 
 
-def query_repos_cached(github_organization: str, github_token: str, verbose: bool = True) -> List[dict]:
-    load_cache(github_organization, verbose)
+def fetch_team_infos(repo_info_list: List[dict], github_token: str, verbose: bool = True,
+                     max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, use_graphql: bool = False) -> dict:
+    return run_scanner_coroutine(fetch_team_infos_async(repo_info_list, github_token, verbose, max_in_flight,
+                                                        use_graphql))
+
+
+def _org_repos_by_push_url(github_organization: str, page_number: int = 1) -> str:
+    # When we're refreshing the repo listing incrementally, we ask for the repos most recently pushed first.
+    return _paged_url('https://api.github.com/orgs/%s/repos?sort=pushed&direction=desc' % github_organization,
+                      page_number)
+
+
+async def _org_repo_count_async(github_organization: str, github_token: str, verbose: bool = True) -> Optional[int]:
+    """
+    Returns how many repos GitHub says the organization has, or None if we can't tell. GitHub only
+    reports the private repos to members of the organization, so for anybody else, this is None.
+    """
+    org = (await _github_get_cached_async('https://api.github.com/orgs/' + github_organization, github_token,
+                                          verbose))['body']
+    if 'total_private_repos' not in org:
+        return None
+    return org.get('public_repos', 0) + org['total_private_repos']
+
+
+async def _refresh_repo_listing_incremental_async(github_organization: str, etag: str, github_token: str,
+                                                  verbose: bool = True) -> Optional[dict]:
+    """
+    Brings the cached repo listing up to date by walking the org's repos, most recently pushed first,
+    until we get back to repos we've already seen. Every new repo and every push shows up at the front
+    of this ordering, so this is usually one or two requests. What it can't see is a repo that went away,
+    so we also compare the total number of repos against what we'd expect, and if that doesn't match,
+    we return None and the caller rescans everything. Otherwise, returns the same dict as store_repo_listing.
+    """
+    cached = {repo['name']: repo.get('pushed_at') or '' for repo in load_repos(github_organization)}
+    watermark = max(cached.values(), default='')
+    if watermark == '':
+        return None
+
+    changed = []
+    page_number = 1
+    last_page = 1
+    last_page_body = None
+    while True:
+        page = await _github_get_cached_async(_org_repos_by_push_url(github_organization, page_number),
+                                              github_token, verbose)
+        if page_number == 1:
+            last_page = max(1, _last_page_number(page['link']))
+        if page_number == last_page:
+            last_page_body = page['body']
+
+        changed.extend(repo for repo in page['body']
+                       if repo['name'] not in cached or cached[repo['name']] != (repo.get('pushed_at') or ''))
+
+        # once we're looking at repos that were pushed before anything in our cache, we've caught up
+        if page_number >= last_page or not page['body'] or (page['body'][-1].get('pushed_at') or '') < watermark:
+            break
+        page_number = page_number + 1
+
+    if last_page_body is None:
+        last_page_body = (await _github_get_cached_async(_org_repos_by_push_url(github_organization, last_page),
+                                                         github_token, verbose))['body']
+
+    num_repos = (last_page - 1) * MAX_PAGE_SIZE + len(last_page_body)
+    expected_num_repos = len(set(cached.keys()) | {repo['name'] for repo in changed})
+    if num_repos != expected_num_repos:
+        if verbose:
+            print("GitHub reports %d repos in %s, but we expected %d; rescanning everything"
+                  % (num_repos, github_organization, expected_num_repos))
+        return None
+
+    if verbose:
+        print("Incremental refresh of %s: %d new or changed repos over %d pages"
+              % (github_organization, len(changed), page_number))
+
+    return store_repo_listing(github_organization, etag, changed, complete=False)
+
+
+# When several tools run back to back, there's no point in each of them asking GitHub whether the repo
+# listing is still current. If we last checked less than REPO_LISTING_MAX_AGE seconds ago, we use the
+# cached listing as is. If it's been longer, but less than REPO_LISTING_STALE_AGE seconds, we still use
+# the cached listing right away, but also check it in a background thread, for the benefit of whoever asks
+# next. Past that, we check before going on, like always. Callers that need an up-to-the-moment listing
+# can ask for a max_age of zero.
+REPO_LISTING_MAX_AGE = 60
+REPO_LISTING_STALE_AGE = 600
+_background_refreshes = {}
+
+
+def _or_default(value, default):
+    return default if value is None else value
+
+
+def _run_background_refresh(github_organization: str, github_token: str):
+    # aiohttp sessions belong to one event loop, and event loops to one thread, so this thread gets its own
+    async def refresh():
+        try:
+            await refresh_repo_listing_async(github_organization, github_token, verbose=False)
+        finally:
+            await close_scanner_session_async()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(refresh())
+    finally:
+        loop.close()
+
+
+def refresh_repo_listing_in_background(github_organization: str, github_token: str):
+    """
+    Starts refreshing the cached listing of the organization's repos in a background thread, unless that's
+    already happening. The thread isn't a daemon, so even if the program is otherwise done, it'll wait for
+    the refresh to finish and be saved, and the next program to run gets the benefit.
+    """
+    thread = _background_refreshes.get(github_organization)
+    if thread is None or not thread.is_alive():
+        thread = threading.Thread(target=_run_background_refresh, args=(github_organization, github_token),
+                                  name='refresh ' + github_organization)
+        _background_refreshes[github_organization] = thread
+        thread.start()
+
+
+async def _check_repo_listing_async(github_organization: str, github_token: str, verbose: bool = True,
+                                    incremental: bool = True, max_age: float = 0,
+                                    stale_age: float = 0) -> (str, dict):
+    """
+    Checks whether the cached listing of the organization's repos is current, and if it isn't, tries
+    to bring it up to date incrementally. Returns a tuple of the ETag to use for a full rescan (or an empty
+    string if no rescan is necessary) and a dict with the names of the repos 'added' and 'removed' so far.
+    The max_age and stale_age are as described for REPO_LISTING_MAX_AGE and REPO_LISTING_STALE_AGE.
+    """
+    _import_legacy_cache(github_organization, verbose)
+
+    if repo_listing_etag(github_organization) != "" and webhook_receiver_is_live(github_organization):
+        if verbose:
+            print('Cached result for ' + github_organization + ' is being kept current by a webhook receiver')
+        return "", {'added': [], 'removed': []}
+
+    age = repo_listing_age(github_organization)
+    if age < max_age:
+        if verbose:
+            print('Cached result for %s was checked %d seconds ago' % (github_organization, age))
+        return "", {'added': [], 'removed': []}
+    elif age < stale_age:
+        if verbose:
+            print('Cached result for %s was checked %d seconds ago, checking again in the background'
+                  % (github_organization, age))
+        refresh_repo_listing_in_background(github_organization, github_token)
+        return "", {'added': [], 'removed': []}
 
     # How we can tell if our cache is valid: we do a HEAD request to GitHub, which doesn't consume any
     # of our API limit. The result will include an ETag header, which is just an opaque string. Assuming
     # this string is the same as it was last time, then we'll reuse our cached data. If it's different,
-    # then something changed, so we'll rescan everything.
+    # then something changed, so we'll rescan. We ask about the repos in order of their most recent
+    # push, so a push to any repo, or a brand new repo, changes the first page and thus its ETag.
+    # A deleted repo only changes the first page if it was on it, though, so when the ETag matches
+    # we also compare the organization's repo count with how many we have cached.
 
     # Ideally, we'd instead use the GitHub v4 GraphQL APIs, which are much, much more efficient than
     # the v3 REST API we're using, but unfortunately, we found some really nasty bugs in the v4
@@ -143,54 +1630,183 @@ def query_repos_cached(github_organization: str, github_token: str, verbose: boo
     # https://gist.github.com/6a68/4971859
     # https://developer.github.com/v3/#conditional-requests
 
-    request_headers = github_headers(github_token)
-
-    previous_etag = scanner_cache[github_organization]["ETag"] if github_organization in scanner_cache else ""
-    head_status = requests.head('https://api.github.com/orgs/' + github_organization + '/repos',
-                                headers=request_headers)
+    previous_etag = repo_listing_etag(github_organization)
+    head_status = await _github_request_async('HEAD', _org_repos_by_push_url(github_organization), github_token,
+                                              verbose)
     fail_on_github_errors(head_status)
 
     current_etag = head_status.headers["ETag"]
 
     if previous_etag == current_etag:
+        num_repos = await _org_repo_count_async(github_organization, github_token, verbose)
+        num_cached = count_cached_repos(github_organization)
+        if num_repos is None or num_repos == num_cached:
+            if verbose:
+                print('Cached result for ' + github_organization + ' is current')
+            note_repo_listing_current(github_organization)
+            return "", {'added': [], 'removed': []}
+
         if verbose:
-            print('Cached result for ' + github_organization + ' is current')
-        return scanner_cache[github_organization]["Contents"]
+            print('GitHub reports %d repos in %s, but we have %d cached; rescanning'
+                  % (num_repos, github_organization, num_cached))
+        _forget_memoized_urls('https://api.github.com/orgs/%s/repos' % github_organization)
     else:
         if verbose:
             print('Cached result for ' + github_organization + ' is missing or outdated')
+        # anything we've already seen of the listing during this run is outdated too
+        _forget_memoized_urls('https://api.github.com/orgs/%s/repos' % github_organization)
 
-    all_repos_list = parallel_get_github_endpoint_paged_list('orgs/' + github_organization + '/repos',
-                                                             github_token, verbose)
+    if incremental and previous_etag != "":
+        changes = await _refresh_repo_listing_incremental_async(github_organization, current_etag, github_token,
+                                                                verbose)
+        if changes is not None:
+            _report_repo_listing_changes(changes, verbose)
+            return "", changes
 
-    # if verbose:
-    #     sys.stdout.write('Getting team information from GitHub')
-    # team_info_repos(all_repos_list, github_token, verbose)
+    return current_etag, {'added': [], 'removed': []}
 
-    scanner_cache[github_organization] = {}  # force it to exist before we create sub-keys
-    scanner_cache[github_organization]['ETag'] = current_etag
-    scanner_cache[github_organization]['Contents'] = all_repos_list
+
+def _report_repo_listing_changes(changes: dict, verbose: bool = True):
+    if verbose:
+        for name in changes['added']:
+            print("New repo: " + name)
+        for name in changes['removed']:
+            print("Deleted repo: " + name)
+
+
+def _store_rescanned_repo_listing(github_organization: str, etag: str, all_repos_list: List[dict],
+                                  verbose: bool = True) -> dict:
+    had_listing = repo_listing_etag(github_organization) != ""
 
     num_repos = len(all_repos_list)
     if verbose:
         print("Found %d repos in %s" % (num_repos, github_organization))
 
-    if num_repos != 0:
+    if num_repos == 0:
         # if we got an empty list, then something went wrong so don't write it to the cache
-        store_cache(github_organization, verbose)
+        return {'added': [], 'removed': []}
+
+    changes = store_repo_listing(github_organization, etag, all_repos_list)
+    if verbose:
+        print("Wrote cache for " + github_organization)
+    if had_listing:
+        _report_repo_listing_changes(changes, verbose)
+
+    return changes
+
+
+async def refresh_repo_listing_async(github_organization: str, github_token: str, verbose: bool = True,
+                                     incremental: bool = True, max_age: float = 0, stale_age: float = 0) -> dict:
+    """
+    Makes sure the cached listing of the organization's repos is current, refetching it from GitHub
+    if it's missing or out of date. If incremental is True and we already have a cached listing, we
+    try to fetch only the repos that are new or have been pushed to since then. Returns a dict with
+    the names of the repos that were 'added' and 'removed' by this refresh.
+    """
+    rescan_etag, changes = await _check_repo_listing_async(github_organization, github_token, verbose, incremental,
+                                                           max_age, stale_age)
+    if rescan_etag == "":
+        return changes
+
+    all_repos_list = [repo async for repo in
+                      parallel_iter_github_endpoint_paged_list_async('orgs/' + github_organization + '/repos',
+                                                                     github_token, verbose)]
+    return _store_rescanned_repo_listing(github_organization, rescan_etag, all_repos_list, verbose)
+
+
+def refresh_repo_listing(github_organization: str, github_token: str, verbose: bool = True,
+                         incremental: bool = True) -> dict:
+    return run_scanner_coroutine(refresh_repo_listing_async(github_organization, github_token, verbose,
+                                                            incremental))
+
 
-    return all_repos_list
+async def query_repos_cached_async(github_organization: str, github_token: str, verbose: bool = True,
+                                   max_age: float = None, stale_age: float = None) -> List[dict]:
+    await refresh_repo_listing_async(github_organization, github_token, verbose,
+                                     max_age=_or_default(max_age, REPO_LISTING_MAX_AGE),
+                                     stale_age=_or_default(stale_age, REPO_LISTING_STALE_AGE))
+    return load_repos(github_organization)
+
+
+def query_repos_cached(github_organization: str, github_token: str, verbose: bool = True,
+                       max_age: float = None, stale_age: float = None) -> List[dict]:
+    """
+    Returns every repo in the organization, from the cache, making sure it's current first, although
+    the cache is trusted for a while after it was last checked (see REPO_LISTING_MAX_AGE).
+    """
+    return run_scanner_coroutine(query_repos_cached_async(github_organization, github_token, verbose, max_age,
+                                                          stale_age))
+
+
+async def iter_matching_repos_async(github_organization: str,
+                                    github_repo_prefix: str,
+                                    github_token: str,
+                                    verbose: bool = True,
+                                    max_age: float = None,
+                                    stale_age: float = None):
+    """
+    Async generator version of query_matching_repos. If the cache is current, this yields the matching repos
+    straight from the cache, sorted by name. If everything has to be rescanned, matching repos are
+    yielded as each page arrives from GitHub, in no particular order, and the cache is updated once the
+    generator runs to completion.
+    """
+    rescan_etag, changes = await _check_repo_listing_async(github_organization, github_token, verbose,
+                                                           max_age=_or_default(max_age, REPO_LISTING_MAX_AGE),
+                                                           stale_age=_or_default(stale_age, REPO_LISTING_STALE_AGE))
+    if rescan_etag == "":
+        for repo in load_repos(github_organization, github_repo_prefix):
+            yield repo
+        return
+
+    all_repos_list = []
+    async for repo in parallel_iter_github_endpoint_paged_list_async('orgs/' + github_organization + '/repos',
+                                                                     github_token, verbose):
+        all_repos_list.append(repo)
+        if repo['name'].startswith(github_repo_prefix):
+            yield repo
+
+    _store_rescanned_repo_listing(github_organization, rescan_etag, all_repos_list, verbose)
+
+
+def iter_matching_repos(github_organization: str,
+                        github_repo_prefix: str,
+                        github_token: str,
+                        verbose: bool = True,
+                        max_age: float = None,
+                        stale_age: float = None):
+    """
+    Generator version of query_matching_repos, behaving just like iter_matching_repos_async.
+    """
+    return iterate_on_scanner_loop(iter_matching_repos_async(github_organization, github_repo_prefix,
+                                                             github_token, verbose, max_age, stale_age))
+
+
+async def query_matching_repos_async(github_organization: str,
+                                     github_repo_prefix: str,
+                                     github_token: str,
+                                     verbose: bool = True,
+                                     max_age: float = None,
+                                     stale_age: float = None) -> List[dict]:
+    """
+    Async version of query_matching_repos. Several of these, e.g., for different organizations, can run
+    at the same time on one event loop.
+    """
+    return sorted([repo async for repo in iter_matching_repos_async(github_organization, github_repo_prefix,
+                                                                     github_token, verbose, max_age, stale_age)],
+                  key=lambda repo: repo['name'])
 
 
 def query_matching_repos(github_organization: str,
                          github_repo_prefix: str,
                          github_token: str,
-                         verbose: bool = True) -> List[dict]:
+                         verbose: bool = True,
+                         max_age: float = None,
+                         stale_age: float = None) -> List[dict]:
     """
     This is the function we expect most of our GitHub Classroom utilities to use. Every GitHub repository has
     a URL of the form https://github.com/Organization/Repository/contents, so the arguments given specify
     which organization is being queried and a string prefix for the repositories being matched. The results
-    will be cached to dot-files in the current working directory, such that subsequent queries will run
+    will be cached in a database in the current working directory, such that subsequent queries will run
     more quickly, assuming that there are no new repositories in the given organization.
 
     The results of this call are a list of Python dict objects. The fields that you might find useful
@@ -210,26 +1826,116 @@ def query_matching_repos(github_organization: str,
     :param github_repo_prefix: String prefix to match GitHub Repositories.
     :param github_token: Token for the GitHub API.
     :param verbose: Specifies whether anything should be printed to show the user status updates.
+    :param max_age: If we checked the cache is current less than this many seconds ago, don't check again
+        (default: REPO_LISTING_MAX_AGE).
+    :param stale_age: If we checked the cache is current less than this many seconds ago, use it anyway, but
+        check it again in the background (default: REPO_LISTING_STALE_AGE).
     :return: A list of Python dicts containing the results of the query.
     """
-    result = query_repos_cached(github_organization, github_token, verbose)
-    return [x for x in result if x['name'].startswith(github_repo_prefix)]
+    return run_scanner_coroutine(query_matching_repos_async(github_organization, github_repo_prefix, github_token,
+                                                            verbose, max_age, stale_age))
+
+
+# Rather than asking about every repo to find out which ones have changed, we can ask GitHub for the
+# organization's recent events. GitHub only shows the organization's private repos (i.e., all of a class's
+# repos) in the event stream of an org member, so that's the one we read. The first page comes with an
+# ETag, so polling when nothing has happened is a free "304 Not Modified", and with an X-Poll-Interval,
+# which says how often GitHub wants us to poll (see poll_interval). Note that events can show up on
+# GitHub's end anywhere from seconds to hours after they happen, so this is a hint, not a guarantee.
+
+# The id of the most recent event we've seen for each organization, during this run.
+_org_event_cursors = {}
+
+# Events that can change which repos there are, or what's in them.
+DIRTY_EVENT_TYPES = ['PushEvent', 'CreateEvent']
+
+
+async def org_events_url_async(github_organization: str, github_token: str, verbose: bool = True) -> str:
+    user = await get_github_endpoint_async('user', github_token, verbose)
+    return _paged_url('https://api.github.com/users/%s/events/orgs/%s' % (user['login'], github_organization))
+
+
+async def poll_org_push_events_async(github_organization: str, github_token: str,
+                                     verbose: bool = True) -> Optional[set]:
+    """
+    Polls the organization's event stream, returning the set of full_names of repos that have been
+    pushed to, or created, since the last time we polled. Returns None if we can't tell, either
+    because this is the first poll, or because so much has happened since the last one that we couldn't
+    find our place in the event stream. In that case, the caller should assume every repo might have changed.
+    """
+    url = await org_events_url_async(github_organization, github_token, verbose)
+    cursor = _org_event_cursors.get(github_organization)
+
+    # we're asking about what's changed, so we don't want the answer we remembered from the last poll
+    _forget_memoized_urls(url.split('?')[0])
+    page = await _github_get_cached_async(url, github_token, verbose)
+    if page['revalidated'] and cursor is not None:
+        return set()
+
+    if page['body']:
+        _org_event_cursors[github_organization] = max(int(event['id']) for event in page['body'])
+
+    dirty = set()
+    while True:
+        for event in page['body']:
+            if cursor is not None and int(event['id']) > cursor and event['type'] in DIRTY_EVENT_TYPES:
+                # the repo 'name' in an event is what we usually call its full_name
+                dirty.add(event['repo']['name'])
+
+        if cursor is None or not page['body'] or any(int(event['id']) <= cursor for event in page['body']):
+            break
+
+        next_url = parse_link_header(page['link']).get('next')
+        if next_url is None:
+            # we've run off the end of what GitHub will show us (a few hundred events), without getting
+            # back to where we were last time, so we may have missed something
+            if verbose:
+                print("Too many events in %s since the last poll, rescanning everything" % github_organization)
+            return None
+        page = await _github_get_cached_async(next_url, github_token, verbose)
+
+    if cursor is None:
+        return None
+
+    if verbose and dirty:
+        print("Recent pushes in %s: %s" % (github_organization, ", ".join(sorted(dirty))))
+    return dirty
+
+
+def poll_org_push_events(github_organization: str, github_token: str, verbose: bool = True) -> Optional[set]:
+    return run_scanner_coroutine(poll_org_push_events_async(github_organization, github_token, verbose))
+
+
+async def make_repo_private_async(repo: dict, github_token: str):
+    await _github_request_async('PATCH', 'https://api.github.com/repos/' + repo['full_name'], github_token,
+                                data=json.dumps({'private': True}))
 
 
 def make_repo_private(repo: dict, github_token: str):
-    requests.patch('https://api.github.com/repos/' + repo['full_name'],
-                   headers=github_headers(github_token),
-                   json={'private': True})
+    run_scanner_coroutine(make_repo_private_async(repo, github_token))
+
+
+async def get_github_endpoint_async(endpoint: str, github_token: str, verbose: bool = True) -> dict:
+    if not endpoint.startswith('https:'):
+        endpoint = 'https://api.github.com/' + endpoint
+
+    return (await _github_get_cached_async(endpoint, github_token, verbose))['body']
 
 
 def get_github_endpoint(endpoint: str, github_token: str, verbose: bool = True) -> dict:
+    return run_scanner_coroutine(get_github_endpoint_async(endpoint, github_token, verbose))
+
+
+async def put_github_endpoint_async(endpoint: str, github_token: str, data_dict: dict = {},
+                                    verbose: bool = True) -> dict:
     if not endpoint.startswith('https:'):
         endpoint = 'https://api.github.com/' + endpoint
 
-    result = requests.get(endpoint, headers=github_headers(github_token))
+    result = await _github_request_async('PUT', endpoint, github_token, verbose, data=json.dumps(data_dict))
     fail_on_github_errors(result)
 
-    return result.json()
+    return json.loads(result.body)
+
 
 def put_github_endpoint(endpoint: str, github_token: str, data_dict: dict = {}, verbose: bool = True) -> dict:
     """
@@ -239,121 +1945,152 @@ def put_github_endpoint(endpoint: str, github_token: str, data_dict: dict = {},
     :param data_dict:  The data dictionary that will be converted to JSON and then sent in the request body
     :param verbose:  Ignored 
     """
-    if not endpoint.startswith('https:'):
-        endpoint = 'https://api.github.com/' + endpoint
-
-    result = requests.put(endpoint, headers=github_headers(github_token), data= json.dumps(data_dict))  # Note:If the 'json' parameter is used instead, the content type will be changed to 'application/json'.   See https://docs.python-requests.org/en/latest/user/quickstart/ 
-    fail_on_github_errors(result)
-
-    return result.json()
+    return run_scanner_coroutine(put_github_endpoint_async(endpoint, github_token, data_dict, verbose))
 
 # inspiration for this parallel / asynchronous code:
 # https://pawelmhm.github.io/asyncio/python/aiohttp/2016/04/22/asyncio-aiohttp.html
-async def _fetch(key: str, url: str, session: ClientSession, github_token: str, verbose: bool = True) -> dict:
-    async with session.get(url, headers=github_headers(github_token)) as response:
-        result = await response.read()
-        await fail_on_github_errors_async(response)
-        return {'key': key, 'url': url, 'body': json.loads(result)}
+async def _fetch(key: str, url: str, github_token: str, semaphore: asyncio.Semaphore, verbose: bool = True) -> dict:
+    result = await _github_get_cached_async(url, github_token, verbose, semaphore)
+    result['key'] = key
+    return result
 
 
-async def _parallel_get_github_endpoint(endpoint_list: List[dict], github_token: str, verbose: bool = True) -> dict:
+async def parallel_get_github_endpoint_async(endpoint_list: List[dict], github_token: str, verbose: bool = True,
+                                             max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> dict:
+    # The semaphore bounds how many requests are being worked on at once, so a big fan-out becomes
+    # a steady stream rather than a burst that GitHub will throttle.
+    semaphore = asyncio.Semaphore(max_in_flight)
     tasks = []
-    async with ClientSession() as session:
-        for endpoint in endpoint_list:
-            key = endpoint['key']
-            url = endpoint['url']
-            if not url.startswith('https:'):
-                url = 'https://api.github.com/' + url
-            task = asyncio.ensure_future(_fetch(key, url, session, github_token, verbose))
-            tasks.append(task)
+    for endpoint in endpoint_list:
+        key = endpoint['key']
+        url = endpoint['url']
+        if not url.startswith('https:'):
+            url = 'https://api.github.com/' + url
+        task = asyncio.ensure_future(_fetch(key, url, github_token, semaphore, verbose))
+        tasks.append(task)
 
-        responses = await asyncio.gather(*tasks)
-        return {x['key']: x for x in responses}
+    responses = await asyncio.gather(*tasks)
+    return {x['key']: x for x in responses}
 
 
-def parallel_get_github_endpoint(endpoint_list: List[dict], github_token: str, verbose: bool = True) -> dict:
+def parallel_get_github_endpoint(endpoint_list: List[dict], github_token: str, verbose: bool = True,
+                                 max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> dict:
     """
     Similar to get_github_endpoint, but launches requests in parallel, returning a dictionary where
     the keys are the original endpoint URLs, and the values are the same dictionaries that get_github_endpoint
     would have returned. The endpoint_list is actually a list of dictionaries, which every entry must
     have two fields: 'key', which is an arbitrary string, and 'url', which is what will be fetched.
     The resulting dictionary will preserve these two fields and add a third one, 'body', with the result.
+    At most max_in_flight requests will be outstanding at any given time.
     """
-    loop = asyncio.get_event_loop()
-    future = asyncio.ensure_future(_parallel_get_github_endpoint(endpoint_list, github_token, verbose))
-    return loop.run_until_complete(future)
+    return run_scanner_coroutine(parallel_get_github_endpoint_async(endpoint_list, github_token, verbose,
+                                                                    max_in_flight))
 
 
-def get_github_endpoint_paged_list(endpoint: str, github_token: str, verbose: bool = True) -> List[dict]:
+async def iter_github_endpoint_paged_list_async(endpoint: str, github_token: str, verbose: bool = True):
+    """
+    Async generator version of get_github_endpoint_paged_list: yields each item of a paged listing, one page
+    at a time, following GitHub's "next" links, so the caller can start working before the whole listing
+    has been downloaded.
+    """
     if not endpoint.startswith('https:'):
         endpoint = 'https://api.github.com/' + endpoint
 
-    page_number = 1
-    result_list = []
+    page_url = _paged_url(endpoint)
+    num_pages = 0
+    num_results = 0
 
-    while True:
+    while page_url:
         if verbose:
             sys.stdout.write('.')
             sys.stdout.flush()
 
-        headers = github_headers(github_token)
+        result = await _github_get_cached_async(page_url, github_token, verbose)
+        num_pages = num_pages + 1
+        num_results = num_results + len(result['body'])
+        for item in result['body']:
+            yield item
 
-        result = requests.get(endpoint,
-                              headers=headers,
-                              params={'page': page_number} if page_number > 1 else {})
-        fail_on_github_errors(result)
-        page_number = page_number + 1
+        page_url = parse_link_header(result['link']).get('next')
 
-        result_l = result.json()
+    if verbose:
+        print(" Done.")
+        print("Total %d results found over %d pages" % (num_results, num_pages))
+
+
+def iter_github_endpoint_paged_list(endpoint: str, github_token: str, verbose: bool = True):
+    return iterate_on_scanner_loop(iter_github_endpoint_paged_list_async(endpoint, github_token, verbose))
+
+
+async def get_github_endpoint_paged_list_async(endpoint: str, github_token: str, verbose: bool = True) -> List[dict]:
+    return [item async for item in iter_github_endpoint_paged_list_async(endpoint, github_token, verbose)]
+
+
+def get_github_endpoint_paged_list(endpoint: str, github_token: str, verbose: bool = True) -> List[dict]:
+    return run_scanner_coroutine(get_github_endpoint_paged_list_async(endpoint, github_token, verbose))
 
-        if len(result_l) == 0:
-            if verbose:
-                print(" Done.")
-            break
 
-        result_list = result_list + result_l
+async def parallel_get_github_endpoint_paged_list_async(endpoint: str, github_token: str, verbose: bool = True,
+                                                        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> List[dict]:
+    result = await _get_all_pages_async(endpoint, endpoint, github_token, asyncio.Semaphore(max_in_flight), verbose)
 
     if verbose:
-        print("Total %d results found over %d pages" % (len(result_list), page_number - 1))
+        print("Total %d results found over %d pages (%d unchanged)" % (len(result['body']), result['num_pages'],
+                                                                      result['num_revalidated']))
 
-    return result_list
+    return result['body']
 
 
-def parallel_get_github_endpoint_paged_list(endpoint: str, github_token: str, verbose: bool = True) -> List[dict]:
-    if not endpoint.startswith('https:'):
-        endpoint = 'https://api.github.com/' + endpoint
+def parallel_get_github_endpoint_paged_list(endpoint: str, github_token: str, verbose: bool = True,
+                                            max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> List[dict]:
+    """
+    Similar to get_github_endpoint_paged_list, but fetches all the pages of the listing in parallel.
+    """
+    return run_scanner_coroutine(parallel_get_github_endpoint_paged_list_async(endpoint, github_token, verbose,
+                                                                               max_in_flight))
 
-    headers = github_headers(github_token)
 
-    page1_result = requests.get(endpoint, headers=headers)
-    fail_on_github_errors(page1_result)
+async def parallel_get_github_endpoint_paged_lists_async(endpoint_list: List[dict], github_token: str,
+                                                         verbose: bool = True,
+                                                         max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> dict:
+    semaphore = asyncio.Semaphore(max_in_flight)
+    responses = await asyncio.gather(*[_get_all_pages_async(endpoint['key'], endpoint['url'], github_token,
+                                                            semaphore, verbose)
+                                       for endpoint in endpoint_list])
+    return {x['key']: x for x in responses}
 
-    if "Link" in page1_result.headers:
-        link_header = page1_result.headers["Link"]
-        p = re.compile('page=(\\d+)>; rel="last"')
-        m = p.findall(link_header)
-        if len(m) != 1:
-            if verbose:
-                print("Malformed header, didn't have pagination!")
-            return page1_result.json()
 
-        num_pages = int(m[0])
-    else:
-        # no pagination with a small number of repos in the organization
-        num_pages = 1
+def parallel_get_github_endpoint_paged_lists(endpoint_list: List[dict], github_token: str, verbose: bool = True,
+                                             max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> dict:
+    """
+    Like parallel_get_github_endpoint, except that every URL is a listing, and every page of every
+    listing is fetched, all in parallel. The 'body' of each result is the complete listing.
+    """
+    return run_scanner_coroutine(parallel_get_github_endpoint_paged_lists_async(endpoint_list, github_token,
+                                                                                verbose, max_in_flight))
 
-    if verbose and num_pages > 1:
-        print("Fetching %d pages in parallel" % num_pages)
 
-    urls = ["%s?page=%d" % (endpoint, n) for n in range(1, num_pages + 1)]
-    all_pages = parallel_get_github_endpoint([{"key": url, "url": url} for url in urls], github_token, verbose)
-    ordered_pages = [all_pages[url]['body'] for url in urls]
-    joined_pages = functools.reduce(lambda a, b: a + b, ordered_pages, [])
+async def parallel_iter_github_endpoint_paged_list_async(endpoint: str, github_token: str, verbose: bool = True,
+                                                         max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+    """
+    Async generator that yields every item of a paged listing, a page at a time, as the pages arrive
+    from GitHub. Items arrive in page order within a page, but the pages themselves may arrive in any order.
+    """
+    async for page_number, result in _iter_pages_async(endpoint, github_token, asyncio.Semaphore(max_in_flight),
+                                                       verbose):
+        for item in result['body']:
+            yield item
 
-    if verbose:
-        print("Total %d results found over %d pages" % (len(joined_pages), num_pages))
 
-    return joined_pages
+def parallel_iter_github_endpoint_paged_list(endpoint: str, github_token: str, verbose: bool = True,
+                                             max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+    """
+    Generator version of parallel_get_github_endpoint_paged_list: all the pages are fetched in parallel,
+    and the items on each page are yielded as soon as that page arrives, so callers can filter or
+    process a big listing while the rest of it is still downloading. Pages may arrive in any order.
+    """
+    return iterate_on_scanner_loop(parallel_iter_github_endpoint_paged_list_async(endpoint, github_token, verbose,
+                                                                                  max_in_flight))
 
 
 # And now for a bunch of code to handle times and timezones. This is probably going to
@@ -44,7 +44,7 @@ def main():
     
     
     endpoint = "orgs/{org}/teams/{team_slug}/members".format(org=github_org, team_slug=github_team)
-    result = get_github_endpoint(endpoint, github_token)
+    result = get_github_endpoint_paged_list(endpoint, github_token, verbose=False)
     print("result =", dict_to_pretty_json(result))        
 
 
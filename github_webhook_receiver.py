@@ -0,0 +1,139 @@
+# github_webhook_receiver.py
+# Available subject to the Apache 2.0 License
+# https://www.apache.org/licenses/LICENSE-2.0
+
+import argparse
+import hmac
+import hashlib
+import ipaddress
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from github_config import *
+from github_scanner import *
+
+parser = argparse.ArgumentParser(description='Receives GitHub webhooks for an organization, keeping the local '
+                                             'cache up to date so the other tools needn\'t ask GitHub')
+parser.add_argument('--token',
+                    nargs=1,
+                    default=[default_github_token],
+                    help='GitHub API token')
+parser.add_argument('--org',
+                    nargs=1,
+                    default=[default_github_organization],
+                    help='GitHub organization to scan, default: ' + default_github_organization)
+parser.add_argument('--host',
+                    nargs=1,
+                    default=["127.0.0.1"],
+                    help='address to listen on (default: 127.0.0.1, so only this machine can reach us; '
+                         'anything else requires --secret)')
+parser.add_argument('--port',
+                    nargs=1,
+                    type=int,
+                    default=[8000],
+                    help='port to listen on (default: 8000)')
+parser.add_argument('--secret',
+                    nargs=1,
+                    default=[""],
+                    help='the webhook\'s secret, used to check that deliveries really come from GitHub '
+                         '(default: no checking)')
+parser.add_argument('--record',
+                    nargs=1,
+                    default=[""],
+                    help='file to append every delivery to, one JSON object per line, for use with --replay')
+parser.add_argument('--replay',
+                    nargs='+',
+                    default=[],
+                    help='instead of listening, apply the deliveries recorded in these files, then exit')
+
+args = parser.parse_args()
+
+github_organization = args.org[0]
+github_token = args.token[0]
+host = args.host[0]
+port = args.port[0]
+webhook_secret = args.secret[0]
+record_file_name = args.record[0]
+replay_file_names = args.replay
+
+
+def is_loopback(address: str) -> bool:
+    if address == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False  # a host name, which could be anything
+
+
+def signature_is_valid(body: bytes, signature: str) -> bool:
+    expected = 'sha256=' + hmac.new(webhook_secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def record_delivery(event_type: str, payload: dict):
+    if record_file_name:
+        with open(record_file_name, 'a') as file:
+            file.write(json.dumps({'event': event_type, 'payload': payload}) + "\n")
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if webhook_secret and not signature_is_valid(body, self.headers.get('X-Hub-Signature-256', '')):
+            print("Rejected a delivery with a bad signature from " + self.client_address[0])
+            self.send_response(401)
+            self.end_headers()
+            return
+
+        event_type = self.headers.get('X-GitHub-Event', '')
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        record_delivery(event_type, payload)
+        if event_type != 'ping':
+            apply_webhook_event(event_type, payload)
+        note_webhook_heartbeat(github_organization)
+
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass  # apply_webhook_event prints what matters
+
+
+if replay_file_names:
+    num_deliveries = 0
+    for replay_file_name in replay_file_names:
+        with open(replay_file_name, 'r') as file:
+            for line in file:
+                if line.strip():
+                    delivery = json.loads(line)
+                    apply_webhook_event(delivery['event'], delivery['payload'])
+                    num_deliveries = num_deliveries + 1
+    print("Replayed %d deliveries" % num_deliveries)
+    exit(0)
+
+# Other tools trust whatever we tell them, so a forged delivery (say, that every repo was deleted) would make
+# them give wrong answers. If anyone other than this machine can reach us, we insist on checking signatures.
+if not webhook_secret and not is_loopback(host):
+    print("Refusing to listen on %s without --secret, since anyone who can reach it could forge deliveries" % host)
+    exit(1)
+
+# Start from a current listing, after which the webhooks keep it current.
+query_repos_cached(github_organization, github_token, max_age=0, stale_age=0)
+
+server = HTTPServer((host, port), WebhookHandler)
+server.timeout = WEBHOOK_HEARTBEAT_INTERVAL
+print("Listening for webhooks for %s on %s port %d (Ctrl-C to stop)" % (github_organization, host, port))
+
+try:
+    while True:
+        note_webhook_heartbeat(github_organization)
+        server.handle_request()
+except KeyboardInterrupt:
+    print("")
+finally:
+    server.server_close()